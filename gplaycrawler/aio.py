@@ -0,0 +1,127 @@
+# stdlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+
+# external
+from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
+
+# internal
+from gplaycrawler.session import Backoff
+from gplaycrawler.utils import get_logger
+
+
+class AsyncEngine:
+    '''
+    Run the work of a command on an asyncio event loop instead of one thread per worker.
+
+    playstoreapi is built on (blocking) requests, so every api call is handed to an executor.
+    All bookkeeping (queue, done sets, output files) stays on the event loop and at most
+    `concurrency` requests are in flight at the same time.
+
+    The api objects come from a SessionPool, its factory can be replaced to run the engine
+    against a local stand-in server.
+    '''
+
+    def __init__(self, concurrency=64, log_level='info'):
+        self.concurrency = concurrency
+        self.log = get_logger(log_level, name=__name__)
+        self.pool = None
+        self.executor = None
+        self.semaphore = None
+
+    def run(self, pool, main, *args):
+        '''
+        login with the SessionPool pool and run the coroutine function main(*args) on a new event loop
+        '''
+        self.pool = pool
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='Async')
+        try:
+            return asyncio.run(self._run(main, *args))
+        finally:
+            self.executor.shutdown(wait=True)
+
+    async def _run(self, main, *args):
+        # the semaphore has to be created inside the running loop (python < 3.10)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        await self.offload(self.pool.get)
+        return await main(*args)
+
+    async def offload(self, fn, *args, **kwargs):
+        '''
+        run a blocking function in the executor without counting it as request
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    async def call(self, fn, *args, **kwargs):
+        '''
+        run a blocking api call in the executor, limited to `concurrency` calls at the same time
+        '''
+        async with self.semaphore:
+            return await self.offload(fn, *args, **kwargs)
+
+    async def request(self, fn, *args, **kwargs):
+        '''
+        like call, but runs fn(api, *args, **kwargs) with the api object of the executor thread.
+        fn can also be the name of an api method
+        '''
+
+        def run():
+            api = self.pool.get()
+            if isinstance(fn, str):
+                return getattr(api, fn)(*args, **kwargs)
+            return fn(api, *args, **kwargs)
+
+        return await self.call(run)
+
+    async def drain(self, q, handler, tasks=None):
+        '''
+        take items from the asyncio.Queue q until it is empty and pass them to the coroutine function handler(item).
+        Items that fail because of rate limiting, timeouts or connection errors are added back to the queue.
+        Handlers can add new items, so a task only stops when no other handler is running and q is not fed anymore
+        (see AsyncFeedQueue). tasks is the number of items handled at the same time (default: concurrency)
+        '''
+        busy = 0
+
+        async def task():
+            nonlocal busy
+            backoff = Backoff()
+            while True:
+                try:
+                    item = q.get_nowait()
+                except asyncio.QueueEmpty:
+                    if busy == 0 and not getattr(q, 'feeding', False):
+                        return
+                    await asyncio.sleep(0.1)
+                    continue
+                busy += 1
+                generation = self.pool.generation
+                try:
+                    await handler(item)
+                    backoff.reset()
+                except HTTPError as e:
+                    if e.response.status_code == 429 or e.response.status_code == 401:
+                        if e.response.status_code == 401:
+                            self.log.warning('Unauthorized. Trying relogin...')
+                        else:
+                            self.log.warning('async worker got rate limited')
+                            await asyncio.sleep(backoff.delay())
+                        await self.offload(self.pool.relogin, generation)
+                        self.log.debug(f'new api, logged in, add back {item}')
+                        q.put_nowait(item)
+                    else:
+                        self.log.warning(str(e))
+                except (ReadTimeout, ConnectionError) as e:
+                    self.log.debug(f'{type(e).__name__}, add back {item}')
+                    if isinstance(e, ConnectionError):
+                        await asyncio.sleep(backoff.delay())
+                    q.put_nowait(item)
+                except Exception as e:
+                    # a crashed thread worker would just be replaced, so don't let one item stop the others
+                    self.log.warning(f'{item}: {str(e)}')
+                finally:
+                    busy -= 1
+                    q.task_done()
+
+        await asyncio.gather(*(task() for _ in range(tasks or self.concurrency)))
@@ -0,0 +1,319 @@
+# stdlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from importlib import import_module
+from os import path
+import hashlib
+import json
+import multiprocessing
+import struct
+import threading
+import time
+import zipfile
+
+# internal
+from gplaycrawler.utils import get_logger
+
+# attribute names of AndroidManifest.xml by resource id, used when the string pool has no names (obfuscated apks)
+ATTRIBUTES = {
+    0x01010003: 'name',
+    0x0101020C: 'minSdkVersion',
+    0x0101021B: 'versionCode',
+    0x0101021C: 'versionName',
+    0x01010270: 'targetSdkVersion',
+}
+
+
+def axml_strings(data, offset):
+    '''
+    string pool chunk of a binary xml file at offset, returns the list of strings
+    '''
+    header_size, _, count, _, flags, strings_start = struct.unpack_from('<HIIIII', data, offset + 2)
+    utf8 = flags & (1 << 8)
+    strings = []
+    for i in range(count):
+        pos = offset + strings_start + struct.unpack_from('<I', data, offset + header_size + i * 4)[0]
+        if utf8:
+            # length in utf-16 units, then in bytes, each one or two bytes long
+            pos += 2 if data[pos] & 0x80 else 1
+            length = data[pos]
+            if length & 0x80:
+                length = (length & 0x7F) << 8 | data[pos + 1]
+                pos += 1
+            start = pos + 1
+            stop = start + length
+            strings.append(data[start:stop].decode('utf-8', 'replace'))
+        else:
+            length = struct.unpack_from('<H', data, pos)[0]
+            if length & 0x8000:
+                length = (length & 0x7FFF) << 16 | struct.unpack_from('<H', data, pos + 2)[0]
+                pos += 2
+            start = pos + 2
+            stop = start + length * 2
+            strings.append(data[start:stop].decode('utf-16-le', 'replace'))
+    return strings
+
+
+def axml_elements(data):
+    '''
+    (tag, attributes) of the start elements of a binary xml file (like AndroidManifest.xml in an apk)
+    '''
+    strings = []
+    resources = []
+    offset = struct.unpack_from('<H', data, 2)[0]
+    while offset + 8 <= len(data):
+        kind, header_size, size = struct.unpack_from('<HHI', data, offset)
+        if size < 8:
+            break
+        if kind == 0x0001:
+            strings = axml_strings(data, offset)
+        elif kind == 0x0180:
+            resources = struct.unpack_from(f'<{(size - header_size) // 4}I', data, offset + header_size)
+        elif kind == 0x0102:
+            ext = offset + header_size
+            _, name, start, attribute_size, count = struct.unpack_from('<IIHHH', data, ext)
+            attributes = {}
+            for i in range(count):
+                pos = ext + start + i * attribute_size
+                _, index, raw, _, _, value_type, value = struct.unpack_from('<IIIHBBI', data, pos)
+                key = strings[index] if index < len(strings) else ''
+                # the resource map has the ids of the first strings
+                if not key and index < len(resources):
+                    key = ATTRIBUTES.get(resources[index], '')
+                if raw != 0xFFFFFFFF:
+                    value = strings[raw]
+                elif value_type == 0x03:
+                    value = strings[value]
+                elif value_type == 0x12:
+                    value = value != 0
+                attributes[key] = value
+            yield strings[name], attributes
+        offset += size
+
+
+def manifest(apk):
+    '''
+    package name, versions, sdk levels and permissions from AndroidManifest.xml
+    '''
+    result = {'permissions': []}
+    for tag, attributes in axml_elements(apk.read('AndroidManifest.xml')):
+        if tag == 'manifest':
+            result['package'] = attributes.get('package')
+            result['versionCode'] = attributes.get('versionCode')
+            result['versionName'] = attributes.get('versionName')
+        elif tag == 'uses-sdk':
+            result['minSdk'] = attributes.get('minSdkVersion')
+            result['targetSdk'] = attributes.get('targetSdkVersion')
+        elif tag in ('uses-permission', 'uses-permission-sdk-23') and 'name' in attributes:
+            result['permissions'].append(attributes['name'])
+    return result
+
+
+def native(apk):
+    '''
+    ABIs and names of the native libraries (lib/<abi>/*.so)
+    '''
+    abis = set()
+    libraries = set()
+    for name in apk.namelist():
+        parts = name.split('/')
+        if len(parts) == 3 and parts[0] == 'lib' and parts[2].endswith('.so'):
+            abis.add(parts[1])
+            libraries.add(parts[2])
+    return {'abis': sorted(abis), 'libraries': sorted(libraries)}
+
+
+def der(data, pos):
+    '''
+    tag, start and end of the content of the DER element at pos
+    '''
+    tag, length = data[pos], data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        start = pos
+        pos += length & 0x7F
+        length = int.from_bytes(data[start:pos], 'big')
+    return tag, pos, pos + length
+
+
+def pkcs7_certificates(data):
+    '''
+    DER encoded certificates of a PKCS#7 SignedData block (META-INF/*.RSA, *.DSA, *.EC)
+    '''
+    # ContentInfo { contentType, [0] SignedData { version, digestAlgorithms, contentInfo, [0] certificates } }
+    _, pos, _ = der(data, 0)
+    _, _, pos = der(data, pos)
+    _, pos, _ = der(data, pos)
+    _, pos, _ = der(data, pos)
+    for _ in range(3):
+        _, _, pos = der(data, pos)
+    tag, pos, end = der(data, pos)
+    certificates = []
+    while tag == 0xA0 and pos < end:
+        _, _, stop = der(data, pos)
+        certificates.append(data[pos:stop])
+        pos = stop
+    return certificates
+
+
+def signing_block(filename):
+    '''
+    (scheme id, value) pairs of the APK Signing Block (v2/v3 signatures) or [] for apks without one
+    '''
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(size - 65536 - 22, 0))
+        tail = f.read()
+        eocd = tail.rfind(b'PK\x05\x06')
+        if eocd < 0:
+            return []
+        central_directory = struct.unpack_from('<I', tail, eocd + 16)[0]
+        if central_directory < 32:
+            return []
+        f.seek(central_directory - 24)
+        block_size, magic = struct.unpack('<Q16s', f.read(24))
+        if magic != b'APK Sig Block 42' or block_size > central_directory:
+            return []
+        f.seek(central_directory - block_size - 8)
+        block = f.read(block_size - 16)
+    pairs = []
+    pos = 8
+    while pos + 12 <= len(block):
+        length, scheme = struct.unpack_from('<QI', block, pos)
+        start = pos + 12
+        pos += 8 + length
+        pairs.append((scheme, block[start:pos]))
+    return pairs
+
+
+def prefixed(data, pos=0):
+    '''
+    the uint32 length prefixed values of a sequence in a signing block
+    '''
+    values = []
+    while pos + 4 <= len(data):
+        length = struct.unpack_from('<I', data, pos)[0]
+        start = pos + 4
+        pos = start + length
+        values.append(data[start:pos])
+    return values
+
+
+def signatures(apk):
+    '''
+    signature schemes and SHA-256 of the signing certificates
+    '''
+    schemes = set()
+    certificates = set()
+    for name in apk.namelist():
+        if name.startswith('META-INF/') and name.rsplit('.', 1)[-1] in ('RSA', 'DSA', 'EC'):
+            schemes.add('v1')
+            certificates.update(hashlib.sha256(c).hexdigest() for c in pkcs7_certificates(apk.read(name)))
+    for scheme, value in signing_block(apk.filename):
+        if scheme not in (0x7109871A, 0xF05368C0):
+            continue
+        schemes.add('v2' if scheme == 0x7109871A else 'v3')
+        # signers { signer { signed data { digests, certificates, ... }, ... } }
+        for signer in prefixed(prefixed(value)[0]):
+            signed_data = prefixed(signer)[0]
+            for certificate in prefixed(prefixed(signed_data)[1]):
+                certificates.add(hashlib.sha256(certificate).hexdigest())
+    return {'schemes': sorted(schemes), 'certificates': sorted(certificates)}
+
+
+ANALYZERS = {'manifest': manifest, 'native': native, 'signatures': signatures}
+
+
+def get_analyzer(name):
+    '''
+    analyzer by name: one of ANALYZERS or 'module:function', a function that takes a zipfile.ZipFile
+    and returns something json serializable
+    '''
+    if name in ANALYZERS:
+        return ANALYZERS[name]
+    if ':' not in name:
+        raise ValueError(f'unknown analyzer {name}')
+    module, function = name.split(':', 1)
+    return getattr(import_module(module), function)
+
+
+def analyze(files, analyzers):
+    '''
+    run the analyzers on the zip files of a package (dict name -> path), in a process of the pool.
+    Returns dict name -> {analyzer: result}, an analyzer that fails gets {'error': ...}
+    '''
+    results = {}
+    for name, filepath in files.items():
+        if not zipfile.is_zipfile(filepath):
+            continue
+        results[name] = {}
+        with zipfile.ZipFile(filepath) as apk:
+            for analyzer in analyzers:
+                try:
+                    results[name][analyzer] = get_analyzer(analyzer)(apk)
+                except Exception as e:
+                    results[name][analyzer] = {'error': f'{type(e).__name__}: {str(e)}'}
+    return results
+
+
+class Analysis:
+    '''
+    Analysis stage after the download of packages.
+
+    Finished packages are handed over with submit() and analyzed in a ProcessPoolExecutor, so the CPU bound
+    parsing doesn't hold the GIL of the download threads and the files are read again while they are still
+    in the page cache. At most `backlog` packages wait or run, submit() blocks when that many are pending.
+    The results go to `analysis.jsonl` in directory, one line per package:
+    {"package": ..., "versionCode": ..., "time": ..., "files": {name: {analyzer: result}}}
+    '''
+
+    def __init__(self, directory, analyzers, processes=None, backlog=100, log_level='info'):
+        for analyzer in analyzers:
+            get_analyzer(analyzer)
+        self.analyzers = list(analyzers)
+        self.log = get_logger(log_level, name=__name__)
+        # spawn: forking a process with running download threads can copy held locks
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+        self.backlog = threading.BoundedSemaphore(backlog)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.fp = open(path.join(directory, 'analysis.jsonl'), 'a', encoding='utf-8')
+
+    def submit(self, packageName, versionCode, files):
+        '''
+        analyze the files (dict name -> path) of a finished package
+        '''
+        self.backlog.acquire()
+        try:
+            future = self.executor.submit(analyze, files, self.analyzers)
+        except (BrokenProcessPool, RuntimeError) as e:
+            # the download goes on without the analysis
+            self.backlog.release()
+            self.log.warning(f'{packageName}: analysis failed: {str(e)}')
+            return
+        future.add_done_callback(lambda f: self._done(f, packageName, versionCode))
+
+    def _done(self, future, packageName, versionCode):
+        try:
+            files = future.result()
+        except Exception as e:
+            self.log.warning(f'{packageName}: analysis failed: {str(e)}')
+            return
+        finally:
+            self.backlog.release()
+        entry = {'package': packageName, 'versionCode': versionCode, 'time': int(time.time()), 'files': files}
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.fp.write(line)
+            self.fp.flush()
+            self.count += 1
+
+    def close(self):
+        '''
+        wait for the pending analyses
+        '''
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            self.fp.close()
+        self.log.info(f'Analyzed {self.count} packages')
@@ -0,0 +1,65 @@
+# external
+from requests.exceptions import HTTPError
+from playstoreapi.googleplay import GooglePlayAPI
+
+# internal
+from gplaycrawler.ratelimit import get_limiter
+
+
+class CrawlerAPI(GooglePlayAPI):
+    '''
+    GooglePlayAPI that paces its requests with the rate limiter shared by the whole process
+    instead of the per instance delay
+    '''
+
+    def __init__(self, locale='en_US', timezone='UTC', device_codename='px_3a', limiter=None, **kwargs):
+        kwargs['delay'] = None
+        super().__init__(locale, timezone, device_codename, **kwargs)
+        if limiter is None:
+            limiter = get_limiter()
+        self.limiter = limiter
+
+    def _limited(self, fn, *args, **kwargs):
+        self.limiter.acquire()
+        try:
+            result = fn(*args, **kwargs)
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code == 429:
+                self.limiter.throttled()
+            raise
+        self.limiter.succeeded()
+        return result
+
+    def executeRequestApi2(self, *args, **kwargs):
+        return self._limited(super().executeRequestApi2, *args, **kwargs)
+
+    def download(self, *args, **kwargs):
+        # purchase request, details and delivery are paced on their own
+        return self._limited(super().download, *args, **kwargs)
+
+    def delivery(self, packageName, versionCode=None, *args, **kwargs):
+        result = self._limited(super().delivery, packageName, versionCode, *args, **kwargs)
+        if result is not None:
+            result['versionCode'] = versionCode
+        return result
+
+    def _deliver_data(self, url, cookies):
+        '''
+        like GooglePlayAPI._deliver_data, but only connects when 'data' is read and
+        keeps what a RangeDownloader needs to fetch the file itself
+        '''
+
+        def data():
+            file = super(CrawlerAPI, self)._deliver_data(url, cookies)
+            yield from file['data']
+
+        return {
+            'data': data(),
+            'total_size': None,
+            'chunk_size': 32 * (1 << 10),
+            'url': url,
+            'cookies': cookies,
+            'headers': self.getHeaders(),
+            'verify': self.ssl_verify,
+            'proxies': self.proxies_config,
+        }
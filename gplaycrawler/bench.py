@@ -0,0 +1,332 @@
+# stdlib
+from collections import deque
+from contextlib import redirect_stdout
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import chdir, devnull, listdir
+import json
+import multiprocessing
+import re
+import resource
+import tempfile
+import threading
+import time
+import zlib
+
+# external
+from requests.exceptions import HTTPError
+import requests
+
+# internal
+from gplaycrawler.aio import AsyncEngine
+from gplaycrawler.api import CrawlerAPI
+from gplaycrawler.utils import get_logger
+
+commands = ['charts', 'search', 'related', 'metadata', 'packages']
+
+
+class Backend:
+    '''
+    Synthetic Play Store for benchmarks.
+
+    There is a fixed universe of `apps` package names. Every result is derived from its query with crc32, so
+    runs are reproducible. Lists have `pages` pages of `page_size` ids. Every request takes `latency` seconds.
+    Above `server_rate` requests per second (and at random with probability `error_rate`) it answers with 429.
+    Package files of `apk_size` bytes are served by a local HTTP server that supports range requests.
+    '''
+
+    def __init__(
+        self, apps=10000, page_size=20, pages=3, latency=0.02, server_rate=None, error_rate=0, apk_size=1 << 20
+    ):
+        self.apps = apps
+        self.page_size = page_size
+        self.pages = pages
+        self.latency = latency
+        self.server_rate = server_rate
+        self.error_rate = error_rate
+        self.apk_size = apk_size
+
+        self.requests = 0
+        self.throttled = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.window = deque()
+        self.server = None
+
+    def request(self):
+        '''
+        one api request: count it, wait and maybe answer with 429
+        '''
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            while self.window and now - self.window[0] > 1:
+                self.window.popleft()
+            throttle = self.server_rate is not None and len(self.window) >= self.server_rate
+            if not throttle:
+                self.window.append(now)
+            throttle = throttle or zlib.crc32(str(self.requests).encode()) % 10000 < self.error_rate * 10000
+            if throttle:
+                self.throttled += 1
+        time.sleep(self.latency)
+        if throttle:
+            response = requests.Response()
+            response.status_code = 429
+            raise HTTPError('429 Client Error: Too Many Requests', response=response)
+
+    def ids(self, key, page):
+        return [f'bench.app{zlib.crc32(f"{key}:{page}:{i}".encode()) % self.apps}' for i in range(self.page_size)]
+
+    def page(self, key, prefix, page):
+        '''
+        one cluster of a paginated list
+        '''
+        cluster = {'title': key, 'subItem': [{'id': i} for i in self.ids(key, page)]}
+        if page + 1 < self.pages:
+            cluster['containerMetadata'] = {'nextPageUrl': f'{prefix}?key={key}&page={page + 1}'}
+        return cluster
+
+    @staticmethod
+    def parse(nextPageUrl):
+        m = re.search(r'key=(.*)&page=(\d+)', nextPageUrl)
+        return m[1], int(m[2])
+
+    def topChart(self, cat, chart, nextPageUrl=None):
+        self.request()
+        key, page = self.parse(nextPageUrl) if nextPageUrl else (f'{cat}-{chart}', 0)
+        return {'subItem': [self.page(key, 'topChart', page)]}
+
+    def search(self, query=None, nextPageUrl=None):
+        self.request()
+        key, page = self.parse(nextPageUrl) if nextPageUrl else (query, 0)
+        return [{'subItem': [self.page(key, 'search', page)]}]
+
+    def streamDetails(self, packageName=None, nextPageUrl=None):
+        self.request()
+        if nextPageUrl:
+            key, page = self.parse(nextPageUrl)
+            return {'item': [{'subItem': [self.page(key, 'stream', page)]}]}
+        streams = [self.page(f'{packageName}-{s}', 'stream', 0) for s in ('similar', 'more')]
+        return {'item': [{'subItem': streams}]}
+
+    def doc(self, packageName):
+        versionCode = zlib.crc32(packageName.encode()) % 1000
+        return {
+            'id': packageName,
+            'title': packageName,
+            'descriptionHtml': 'lorem ipsum ' * 100,
+            'details': {'appDetails': {'versionCode': versionCode, 'uploadDate': 'Jan 1, 2021'}},
+        }
+
+    def details(self, packageName):
+        self.request()
+        return self.doc(packageName)
+
+    def bulkDetails(self, packageNames):
+        self.request()
+        return [self.doc(p) for p in packageNames]
+
+    def purchase(self, packageName):
+        # purchase and delivery request
+        self.request()
+        self.request()
+
+    def serve(self):
+        '''
+        start the HTTP server for package files, returns its url
+        '''
+        backend = self
+        data = memoryview((bytes(range(256)) * (self.apk_size // 256 + 1))[: self.apk_size])
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                body = data
+                m = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+                if m:
+                    start, stop = int(m[1]), min(int(m[2]) + 1, len(data))
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{stop - 1}/{len(data)}')
+                    body = data[start:stop]
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with backend.lock:
+                    backend.bytes += len(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+
+class BenchAPI(CrawlerAPI):
+    '''
+    CrawlerAPI answered by a Backend. Requests still go through the rate limiter
+    '''
+
+    def __init__(self, locale='en_US', timezone='UTC', device_codename='px_3a', limiter=None, backend=None, url=None):
+        super().__init__(locale, timezone, device_codename, limiter=limiter)
+        self.backend = backend
+        self.url = url
+
+    def envLogin(self, quiet=True, check=False):
+        self.gsfId = 1
+        self.authSubToken = 'bench'
+
+    def topChart(self, cat, chart, nextPageUrl=None):
+        return self._limited(self.backend.topChart, cat, chart, nextPageUrl=nextPageUrl)
+
+    def search(self, query=None, nextPageUrl=None):
+        return self._limited(self.backend.search, query=query, nextPageUrl=nextPageUrl)
+
+    def streamDetails(self, packageName=None, nextPageUrl=None):
+        return self._limited(self.backend.streamDetails, packageName=packageName, nextPageUrl=nextPageUrl)
+
+    def details(self, packageName):
+        return self._limited(self.backend.details, packageName)
+
+    def bulkDetails(self, packageNames):
+        return self._limited(self.backend.bulkDetails, packageNames)
+
+    def download(self, packageName, versionCode=None, offerType=1, expansion_files=False):
+        self._limited(self.backend.purchase, packageName)
+        return {
+            'docId': packageName,
+            'versionCode': self.backend.doc(packageName)['details']['appDetails']['versionCode'],
+            'file': self._deliver_data(f'{self.url}/{packageName}.apk', None),
+            'additionalData': [],
+            'splits': [],
+        }
+
+
+def case(command, threads, engine, options):
+    '''
+    run one command against a Backend in the current directory and measure it
+    '''
+    from gplaycrawler.charts import Charts
+    from gplaycrawler.metadata import Metadata
+    from gplaycrawler.packages import Packages
+    from gplaycrawler.related import Related
+    from gplaycrawler.search import Search
+
+    backend = Backend(
+        apps=options['apps'],
+        page_size=options['page_size'],
+        pages=options['pages'],
+        latency=options['latency'],
+        server_rate=options['server_rate'],
+        error_rate=options['error_rate'],
+        apk_size=options['apk_size'],
+    )
+    url = backend.serve() if command == 'packages' else None
+    classes = {'charts': Charts, 'search': Search, 'related': Related, 'metadata': Metadata, 'packages': Packages}
+    cmd = classes[command](delay=options['delay'], log_level='warning')
+    cmd.pool.factory = partial(BenchAPI, backend=backend, url=url)
+    if engine == 'async':
+        engine = AsyncEngine(concurrency=options['concurrency'], log_level='warning')
+    else:
+        engine = None
+
+    with open('in.json', 'w') as f:
+        json.dump([f'bench.app{i}' for i in range(options['items'])], f)
+
+    start = time.monotonic()
+    if command == 'charts':
+        cmd.getCharts('out.json')
+    elif command == 'search':
+        cmd.getSearch('out.json', threads, options['length'], engine=engine, adaptive=options['adaptive'])
+    elif command == 'related':
+        cmd.getRelated('in.json', 'out', until_level=options['level'], threads=threads, engine=engine)
+    elif command == 'metadata':
+        cmd.getMetadata('in.json', 'out', threads, engine=engine, bulk=options['bulk'])
+    elif command == 'packages':
+        cmd.getPackages('in.json', 'out', threads, False, False, engine=engine)
+    elapsed = time.monotonic() - start
+
+    if command == 'charts':
+        with open('out.json') as f:
+            ids = sum(len(chart) for cat in json.load(f).values() for chart in cat.values())
+    elif command in ('search', 'related'):
+        with open('out.json') as f:
+            ids = len(json.load(f)['ids'])
+    else:
+        suffix = '.json' if command == 'metadata' else '.apk'
+        ids = len([name for name in listdir('out') if name.endswith(suffix)])
+
+    frontier = getattr(cmd, 'frontier', None)
+    return {
+        'command': command,
+        'threads': threads,
+        'engine': 'async' if engine else 'threads',
+        'seconds': round(elapsed, 3),
+        'requests': backend.requests,
+        'throttled': backend.throttled,
+        'requests/s': round(backend.requests / elapsed, 1),
+        'ids': ids,
+        'ids/s': round(ids / elapsed, 1),
+        'MB/s': round(backend.bytes / elapsed / 1e6, 1),
+        # kilobytes on linux
+        'peak RSS MB': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'checkpoints': frontier.checkpoints if frontier else None,
+        'checkpoint s': round(frontier.checkpoint_time, 3) if frontier else None,
+    }
+
+
+def _run(command, threads, engine, options, results):
+    # keep the progress output of charts out of the report
+    with tempfile.TemporaryDirectory() as d, open(devnull, 'w') as null, redirect_stdout(null):
+        chdir(d)
+        results.put(case(command, threads, engine, options))
+
+
+class Bench:
+    def __init__(self, log_level='info'):
+        self.log = get_logger(log_level, name=__name__)
+
+    def run(self, cmds, threads, engines, options, timeout=600):
+        '''
+        run every command with every number of threads (and engine) in its own process.
+        The async engine ignores threads and runs once with options['concurrency']
+        '''
+        ctx = multiprocessing.get_context('spawn')
+        reports = []
+        for command in cmds:
+            for engine in engines:
+                # charts always uses one thread per chart
+                for n in [None] if engine == 'async' or command == 'charts' else threads:
+                    self.log.info(f'Running {command} (engine: {engine}, threads: {n})')
+                    results = ctx.Queue()
+                    p = ctx.Process(target=_run, args=(command, n, engine, options, results))
+                    p.start()
+                    try:
+                        report = results.get(timeout=timeout)
+                    except Exception:
+                        report = {'command': command, 'threads': n, 'engine': engine, 'seconds': 'timeout'}
+                        p.terminate()
+                    p.join()
+                    self.log.info(report)
+                    reports.append(report)
+        return reports
+
+    @staticmethod
+    def table(reports):
+        columns = []
+        for report in reports:
+            columns += [c for c in report if c not in columns]
+        rows = [columns] + [[str(report.get(c, '')) for c in columns] for report in reports]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+        return '\n'.join('  '.join(cell.rjust(w) for cell, w in zip(row, widths)) for row in rows)
+
+    def getBench(self, cmds, threads, engines, options, out_file=None, timeout=600):
+        reports = self.run(cmds, threads, engines, options, timeout=timeout)
+        print(self.table(reports))
+        if out_file is not None:
+            self.log.info(f'Writing to file {out_file}')
+            with open(out_file, 'w') as f:
+                json.dump({'options': options, 'results': reports}, f, indent=2)
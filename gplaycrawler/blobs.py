@@ -0,0 +1,134 @@
+# stdlib
+from os import path, makedirs, listdir, remove, replace
+import hashlib
+import json
+import time
+
+
+class BlobStore:
+    '''
+    Content addressed storage for package files.
+
+    Every file is stored once under its SHA-256 in `blobs/<first two hex digits>/<sha256>`.
+    `manifests/<packageName>/<versionCode>.json` lists the files of one version of a package with their
+    hash and size. Identical files of different versions or crawls share one blob.
+    Downloads go to `tmp/` and are moved into place by add(). A manifest is only written after all files
+    of a package are stored, so a manifest means a complete package.
+    Old versions are dropped with prune(), their blobs are only deleted by gc() when no manifest needs them.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tmp = path.join(directory, 'tmp')
+        self.blobs = path.join(directory, 'blobs')
+        self.manifests = path.join(directory, 'manifests')
+        for d in (self.tmp, self.blobs, self.manifests):
+            makedirs(d, exist_ok=True)
+
+    def blob_path(self, sha256):
+        return path.join(self.blobs, sha256[:2], sha256)
+
+    def add(self, filepath, sha256):
+        '''
+        move the file at filepath (with the hash sha256) into the store. Returns True if the blob is new
+        '''
+        blob = self.blob_path(sha256)
+        if path.exists(blob):
+            remove(filepath)
+            return False
+        makedirs(path.dirname(blob), exist_ok=True)
+        replace(filepath, blob)
+        return True
+
+    def write_manifest(self, packageName, versionCode, files):
+        '''
+        files: dict file name -> {'sha256': ..., 'size': ...}
+        '''
+        directory = path.join(self.manifests, packageName)
+        makedirs(directory, exist_ok=True)
+        filepath = path.join(directory, f'{versionCode}.json')
+        manifest = {'package': packageName, 'versionCode': versionCode, 'time': int(time.time()), 'files': files}
+        with open(filepath + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        replace(filepath + '.tmp', filepath)
+
+    def versions(self, packageName):
+        '''
+        stored versionCodes of packageName, oldest first
+        '''
+        try:
+            names = listdir(path.join(self.manifests, packageName))
+        except FileNotFoundError:
+            return []
+        versions = [name[: -len('.json')] for name in names if name.endswith('.json')]
+        return sorted(versions, key=lambda v: (len(v), v))
+
+    def manifest(self, packageName, versionCode=None):
+        '''
+        manifest of a version of packageName (default: the latest one) or None
+        '''
+        if versionCode is None:
+            versions = self.versions(packageName)
+            if not versions:
+                return None
+            versionCode = versions[-1]
+        try:
+            with open(path.join(self.manifests, packageName, f'{versionCode}.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def packages(self):
+        '''
+        set of packages with at least one complete version
+        '''
+        return {name for name in listdir(self.manifests) if self.versions(name)}
+
+    def verify(self, packageName, versionCode=None):
+        '''
+        hash the blobs of a manifest again, returns the names of missing or broken files
+        '''
+        broken = []
+        manifest = self.manifest(packageName, versionCode) or {'files': {}}
+        for name, info in manifest['files'].items():
+            sha256 = hashlib.sha256()
+            try:
+                with open(self.blob_path(info['sha256']), 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        sha256.update(chunk)
+            except FileNotFoundError:
+                broken.append(name)
+                continue
+            if sha256.hexdigest() != info['sha256']:
+                broken.append(name)
+        return broken
+
+    def prune(self, packageName, keep):
+        '''
+        remove the manifests of all but the latest version and the keep versions before it.
+        Returns the removed versionCodes, their blobs stay until gc()
+        '''
+        versions = self.versions(packageName)
+        n = max(len(versions) - keep - 1, 0)
+        for versionCode in versions[:n]:
+            remove(path.join(self.manifests, packageName, f'{versionCode}.json'))
+        return versions[:n]
+
+    def gc(self):
+        '''
+        delete the blobs no manifest refers to, returns their number and total size
+        '''
+        referenced = set()
+        for packageName in listdir(self.manifests):
+            for versionCode in self.versions(packageName):
+                manifest = self.manifest(packageName, versionCode) or {'files': {}}
+                referenced.update(info['sha256'] for info in manifest['files'].values())
+        count = size = 0
+        for prefix in listdir(self.blobs):
+            for name in listdir(path.join(self.blobs, prefix)):
+                if name not in referenced:
+                    filepath = path.join(self.blobs, prefix, name)
+                    size += path.getsize(filepath)
+                    remove(filepath)
+                    count += 1
+        return count, size
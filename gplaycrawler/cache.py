@@ -0,0 +1,90 @@
+# stdlib
+from collections import OrderedDict
+import hashlib
+import json
+import sqlite3
+import threading
+
+
+class StreamCache:
+    '''
+    Results of Related.streamPages (the ids on all further pages of a stream), bounded with LRU eviction.
+
+    Entries are stored by nextPageUrl and by the identity of the stream (its title and the ids on its first
+    page), because the same stream can be reached with different page urls from different apps.
+    With a filename all entries are also kept in a SQLite database and misses are looked up there,
+    so the cache survives a restart.
+    '''
+
+    def __init__(self, size=10000, filename=None, commit_every=100):
+        self.size = size
+        self.filename = filename
+        self.commit_every = commit_every
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if filename is not None:
+            self.db = sqlite3.connect(filename, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS streams (key TEXT PRIMARY KEY, ids TEXT) WITHOUT ROWID')
+            self.db.commit()
+
+    @staticmethod
+    def identity(stream):
+        '''
+        key of a stream by its title and the ids on its first page
+        '''
+        h = hashlib.sha1()
+        for subItem in stream.get('subItem', []):
+            h.update(subItem.get('id', '').encode() + b'\n')
+        return f"stream:{stream.get('title')}:{h.hexdigest()}"
+
+    def _remember(self, key, ids):
+        self.entries[key] = ids
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, *keys):
+        '''
+        cached ids of the first of keys that is known or None
+        '''
+        with self.lock:
+            for key in keys:
+                ids = self.entries.get(key)
+                if ids is None and self.db is not None:
+                    for (j,) in self.db.execute('SELECT ids FROM streams WHERE key = ?', (key,)):
+                        ids = frozenset(json.loads(j))
+                if ids is not None:
+                    self._remember(key, ids)
+                    self.hits += 1
+                    return ids
+            self.misses += 1
+            return None
+
+    def put(self, keys, ids):
+        '''
+        store ids for all keys
+        '''
+        ids = frozenset(ids)
+        with self.lock:
+            for key in keys:
+                self._remember(key, ids)
+            if self.db is not None:
+                j = json.dumps(list(ids))
+                self.db.executemany('INSERT OR REPLACE INTO streams (key, ids) VALUES (?, ?)', ((k, j) for k in keys))
+                self.pending += 1
+                if self.pending >= self.commit_every:
+                    self.db.commit()
+                    self.pending = 0
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
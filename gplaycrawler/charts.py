@@ -3,7 +3,8 @@ import threading
 import time
 
 from reprint import output
-from playstoreapi.googleplay import GooglePlayAPI, LoginError
+from gplaycrawler.ratelimit import get_limiter
+from gplaycrawler.session import SessionPool
 from gplaycrawler.utils import get_logger
 
 
@@ -13,6 +14,7 @@ class Charts:
         self.timezone = timezone
         self.device = device
         self.delay = delay
+        self.limiter = get_limiter(delay)
 
         self.log_level = log_level
         self.log = get_logger(log_level, name=__name__)
@@ -23,7 +25,9 @@ class Charts:
         else:
             self.quiet = True
 
-    def worker(self, api, categorie, chart, ids):
+        self.pool = SessionPool(locale, timezone, device, limiter=self.limiter, quiet=self.quiet, log=self.log)
+
+    def worker(self, categorie, chart, ids):
         '''
         Get all ids by downloading all pages
         Every page has 6 entries and the api returns ~110 pages resulting in ~660 ids
@@ -32,6 +36,7 @@ class Charts:
             ids[categorie] = {}
         if chart not in ids[categorie]:
             ids[categorie][chart] = []
+        api = self.pool.get()
         nextPageUrl = None
         while True:
             data = api.topChart(cat=categorie, chart=chart, nextPageUrl=nextPageUrl)
@@ -53,11 +58,7 @@ class Charts:
         '''
         parallel downloading of all app charts and saving them in a json file
         '''
-        api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-        try:
-            api.envLogin(quiet=self.quiet, check=False)
-        except LoginError:
-            self.log.info('Login failed.')
+        self.pool.get()
 
         charts = ['apps_topselling_free', 'apps_topselling_paid', 'apps_topgrossing', 'apps_movers_shakers']
         categories = ['APPLICATION', 'GAME']
@@ -65,7 +66,7 @@ class Charts:
         threads = []
         for cat in categories:
             for chart in charts:
-                t = threading.Thread(target=self.worker, args=(api, cat, chart, ids))
+                t = threading.Thread(target=self.worker, args=(cat, chart, ids))
                 t.name = f'{cat}: {chart}'
                 threads.append(t)
                 print('starting thread', t.name)
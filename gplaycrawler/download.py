@@ -0,0 +1,256 @@
+# stdlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from os import path, remove, replace
+import hashlib
+import json
+import threading
+
+# external
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError, ReadTimeout
+import requests
+
+# internal
+from gplaycrawler.ratelimit import TokenBucket
+from gplaycrawler.session import Backoff
+from gplaycrawler.utils import get_logger
+
+
+class DownloadError(Exception):
+    pass
+
+
+class OrderedHash:
+    '''
+    sha256 of a file that arrives in numbered parts in any order.
+    Parts that come before their predecessors are kept until they can be hashed, up to `limit` bytes.
+    The data of the others (and of parts passed as None) is read again with read(i) when it is their turn
+    '''
+
+    def __init__(self, read, limit=64 * 1024 * 1024):
+        self.hash = hashlib.sha256()
+        self.next = 0
+        self.pending = {}
+        self.buffered = 0
+        self.read = read
+        self.limit = limit
+        self.lock = threading.Lock()
+
+    def update(self, i, data=None):
+        with self.lock:
+            if data is not None and i != self.next:
+                if self.buffered + len(data) > self.limit:
+                    data = None
+                else:
+                    self.buffered += len(data)
+            self.pending[i] = data
+            while self.next in self.pending:
+                data = self.pending.pop(self.next)
+                if data is None:
+                    data = self.read(self.next)
+                elif self.next != i:
+                    self.buffered -= len(data)
+                self.hash.update(data)
+                self.next += 1
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class RangeDownloader:
+    '''
+    Download files of a delivery response with parallel HTTP range requests.
+
+    A file is split into parts of `part_size` bytes and up to `parts` of them are downloaded at the same time
+    into `<file>.part`. Finished parts are recorded in `<file>.part.json`, so an interrupted download continues
+    where it stopped. The file only gets its final name after its size matches the size announced by the
+    server. Servers that don't answer range requests get a single streamed download.
+    The SHA-256 of every file is computed from the downloaded data while it is written.
+    With bandwidth (bytes per second) all downloads of the downloader together are paced by one token bucket.
+    A budget (semaphore) passed to fetch() is held during every request, so the files of one package that are
+    fetched at the same time share a number of connections.
+    '''
+
+    def __init__(self, parts=4, part_size=8 * 1024 * 1024, retries=5, bandwidth=None, log_level='info'):
+        self.parts = parts
+        self.part_size = part_size
+        self.retries = retries
+        self.log = get_logger(log_level, name=__name__)
+        self.local = threading.local()
+        self.bucket = None
+        self.set_bandwidth(bandwidth)
+
+    def set_bandwidth(self, bandwidth):
+        '''
+        limit all downloads together to bandwidth bytes per second (None: unlimited), bursts up to one second
+        '''
+        self.bucket = None if bandwidth is None else TokenBucket(bandwidth, capacity=bandwidth)
+
+    def _chunks(self, chunks):
+        for chunk in chunks:
+            if self.bucket is not None:
+                self.bucket.acquire(len(chunk))
+            yield chunk
+
+    def _session(self):
+        # one connection pool per thread
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def _get(self, file, start=None, end=None):
+        headers = dict(file['headers'])
+        if start is not None:
+            headers['Range'] = f'bytes={start}-{end}'
+        response = self._session().get(
+            file['url'],
+            headers=headers,
+            cookies=file['cookies'],
+            verify=file['verify'],
+            proxies=file['proxies'],
+            stream=True,
+            timeout=60,
+        )
+        response.raise_for_status()
+        return response
+
+    def probe(self, file):
+        '''
+        size of the file and whether the server supports range requests
+        '''
+        response = self._get(file, 0, 0)
+        try:
+            content_range = response.headers.get('content-range')
+            if response.status_code == 206 and content_range and '/' in content_range:
+                total = content_range.rsplit('/', 1)[1]
+                if total != '*':
+                    return int(total), True
+            length = response.headers.get('content-length')
+            return (int(length) if length is not None else None), False
+        finally:
+            response.close()
+
+    def _retry(self, fn, name, budget=None):
+        backoff = Backoff(cap=30)
+        for attempt in range(self.retries):
+            try:
+                with budget or nullcontext():
+                    return fn()
+            except (ChunkedEncodingError, ConnectionError, ReadTimeout, HTTPError) as e:
+                if attempt + 1 == self.retries:
+                    raise DownloadError(f'{name}: {str(e)}')
+                self.log.debug(f'{name}: {str(e)}. Retry')
+                backoff.sleep()
+
+    def _stream(self, file, part_file):
+        sha256 = hashlib.sha256()
+        response = self._get(file)
+        try:
+            with open(part_file, 'wb') as f:
+                for chunk in self._chunks(response.iter_content(chunk_size=1 << 16)):
+                    f.write(chunk)
+                    sha256.update(chunk)
+        finally:
+            response.close()
+        return sha256.hexdigest()
+
+    def _range(self, file, part_file, start, end):
+        response = self._get(file, start, end)
+        try:
+            if response.status_code != 206:
+                raise DownloadError(f'range {start}-{end} not supported')
+            data = b''.join(self._chunks(response.iter_content(chunk_size=1 << 16)))
+        finally:
+            response.close()
+        if len(data) != end - start + 1:
+            raise ChunkedEncodingError(f'range {start}-{end}: got {len(data)} bytes')
+        with open(part_file, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+        return data
+
+    def fetch(self, file, filepath, budget=None):
+        '''
+        download the file dict of a delivery response (see CrawlerAPI._deliver_data) to filepath.
+        Returns size and sha256 of the file
+        '''
+        name = path.basename(filepath)
+        part_file = filepath + '.part'
+        state_file = part_file + '.json'
+
+        if 'url' not in file:
+            # plain GooglePlayAPI response, only the stream is known
+            total = file.get('total_size')
+            total = int(total) if total is not None else None
+            sha256 = hashlib.sha256()
+            try:
+                with budget or nullcontext(), open(part_file, 'wb') as f:
+                    for chunk in self._chunks(file['data']):
+                        f.write(chunk)
+                        sha256.update(chunk)
+            except (ChunkedEncodingError, ConnectionError, ReadTimeout) as e:
+                raise DownloadError(f'{name}: {str(e)}')
+            digest = sha256.hexdigest()
+        else:
+            total, digest = self._fetch(file, name, part_file, state_file, budget)
+
+        size = path.getsize(part_file)
+        if total is not None and size != total:
+            remove(part_file)
+            raise DownloadError(f'{name}: size {size} != {total}')
+        replace(part_file, filepath)
+        try:
+            remove(state_file)
+        except FileNotFoundError:
+            pass
+        return size, digest
+
+    def _fetch(self, file, name, part_file, state_file, budget=None):
+        total, ranges = self._retry(lambda: self.probe(file), name, budget)
+
+        if not ranges or total is None or total <= self.part_size:
+            return total, self._retry(lambda: self._stream(file, part_file), name, budget)
+
+        todo = set(range((total + self.part_size - 1) // self.part_size))
+        done = set()
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+            if state['size'] == total and path.exists(part_file):
+                done = set(state['done'])
+                self.log.debug(f'{name}: resume with {len(done)} of {len(todo)} parts')
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+        if not done:
+            with open(part_file, 'wb') as f:
+                f.truncate(total)
+        lock = threading.Lock()
+
+        def read(i):
+            start = i * self.part_size
+            with open(part_file, 'rb') as f:
+                f.seek(start)
+                return f.read(min(total, start + self.part_size) - start)
+
+        # parts that wait for a stalled one are dropped past parts * part_size and read back
+        sha256 = OrderedHash(read, limit=self.parts * self.part_size)
+
+        def part(i):
+            start = i * self.part_size
+            end = min(total, start + self.part_size) - 1
+            if i in done:
+                # parts of an earlier run are read back when it is their turn
+                sha256.update(i)
+                return
+            data = self._retry(lambda: self._range(file, part_file, start, end), f'{name} part {i}', budget)
+            sha256.update(i, data)
+            with lock:
+                done.add(i)
+                with open(state_file, 'w') as f:
+                    json.dump({'size': total, 'done': sorted(done)}, f)
+
+        with ThreadPoolExecutor(max_workers=self.parts) as executor:
+            # list() to raise the first error
+            list(executor.map(part, sorted(todo)))
+        return total, sha256.hexdigest()
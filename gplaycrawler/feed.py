@@ -0,0 +1,193 @@
+# stdlib
+from itertools import islice
+import asyncio
+import json
+import queue
+import re
+import threading
+
+# internal
+from gplaycrawler.ids import IdRegistry, IdSet
+
+# one json token after optional whitespace: a string, a structural char or anything else (numbers, literals)
+TOKEN = re.compile(r'\s*(?:("[^"\\]*(?:\\.[^"\\]*)*")|([\[\]{}:,])|([^\s\[\]{}:,"]+))')
+
+
+def read_ids(filename, skip=(), chunk_size=1 << 16):
+    '''
+    iterate the ids of a json input file without loading all of it: every string in an array or at top level,
+    except the ones below an object key in skip.
+    That covers a list of ids, {"done": [...], "ids": [...]}, charts.json and jsonl with one string per line.
+    The file is opened right away, so a missing file raises FileNotFoundError here and not while iterating
+    '''
+    f = open(filename, encoding='utf-8')
+
+    def tokens():
+        with f:
+            buffer = ''
+            pos = 0
+            eof = False
+            while True:
+                m = TOKEN.match(buffer, pos)
+                # a token at the end of the buffer can go on in the next chunk
+                if not eof and (m is None or m.end() == len(buffer)):
+                    chunk = f.read(chunk_size)
+                    eof = not chunk
+                    buffer = buffer[pos:] + chunk
+                    pos = 0
+                    continue
+                if m is None:
+                    if buffer[pos:].strip():
+                        raise ValueError(f'{filename}: invalid json at {buffer[pos:pos + 20]!r}')
+                    return
+                pos = m.end()
+                yield m.groups()
+
+    def decode(string):
+        return json.loads(string) if '\\' in string else string[1:-1]
+
+    def ids():
+        # open containers as (char, skipped), the last string in an object is the key of the next value
+        stack = []
+        key = None
+        for string, char, literal in tokens():
+            if literal is not None:
+                continue
+            skipped = bool(stack) and stack[-1][1]
+            if string is not None:
+                if not stack:
+                    yield decode(string)
+                elif stack[-1][0] == '{':
+                    key = string
+                elif not skipped:
+                    yield decode(string)
+            elif char in '[{':
+                if stack and stack[-1][0] == '{' and key is not None and json.loads(key) in skip:
+                    skipped = True
+                stack.append((char, skipped))
+            elif char in ']}':
+                if not stack:
+                    raise ValueError(f'{filename}: unbalanced {char}')
+                stack.pop()
+
+    return ids()
+
+
+def unique(ids, skip=()):
+    '''
+    ids that are not in skip, each only once
+    '''
+    seen = IdSet(IdRegistry())
+    for i in ids:
+        if i not in skip and i not in seen:
+            seen.add(i)
+            yield i
+
+
+def start_feeder(q, items, limit=10000):
+    '''
+    fill the queue.Queue q from the iterator items in a feeder thread, returns the thread (see FeedQueue)
+    '''
+    with q.mutex:
+        q.unfinished_tasks += 1
+
+    def feed():
+        try:
+            for item in items:
+                with q.not_full:
+                    while q._qsize() >= limit:
+                        q.not_full.wait()
+                    q._put(item)
+                    q.unfinished_tasks += 1
+                    q.not_empty.notify()
+        finally:
+            q.task_done()
+
+    feeder = threading.Thread(target=feed, name='Feeder', daemon=True)
+    feeder.start()
+    return feeder
+
+
+def start_async_feeder(engine, q, items, limit=10000, chunk_size=1000):
+    '''
+    asyncio version of start_feeder for any asyncio.Queue q, the items are read in the executor of engine.
+    Returns the task, `q.feeding` tells AsyncEngine.drain that more items will come
+    '''
+    items = iter(items)
+    q.feeding = True
+
+    async def feed():
+        try:
+            while True:
+                chunk = await engine.offload(list, islice(items, chunk_size))
+                if not chunk:
+                    return
+                for item in chunk:
+                    q.put_nowait(item)
+                while q.qsize() >= limit:
+                    await asyncio.sleep(0.1)
+        finally:
+            q.feeding = False
+
+    return asyncio.ensure_future(feed())
+
+
+class FeedQueue(queue.Queue):
+    '''
+    queue.Queue that is filled from an iterator by a feeder thread, so workers can start before a big input
+    is read. The feeder waits while `limit` items are queued, items put back by workers are always accepted.
+    While the feeder runs it counts as unfinished task, so workers that stop at `unfinished_tasks == 0`
+    don't stop early. The feeder is started with start(), AsyncFeedQueue can take over the items instead
+    '''
+
+    def __init__(self, items, limit=10000):
+        super().__init__()
+        self.items = iter(items)
+        self.limit = limit
+        self.feeder = None
+
+    def start(self):
+        self.feeder = start_feeder(self, self.items, self.limit)
+
+
+class AsyncFeedQueue(asyncio.Queue):
+    '''
+    asyncio version of FeedQueue, filled by the coroutine feed() that reads the iterator in the executor of
+    the engine. With batch the items are grouped into lists of that size (for bulk requests).
+    `feeding` tells AsyncEngine.drain that more items will come
+    '''
+
+    def __init__(self, items, limit=10000, batch=None):
+        super().__init__()
+        self.items = iter(items)
+        self.limit = limit
+        self.batch = batch
+        self.feeding = True
+        self.room = asyncio.Event()
+
+    def get_nowait(self):
+        item = super().get_nowait()
+        if self.qsize() < self.limit:
+            self.room.set()
+        return item
+
+    def _read(self, n):
+        items = list(islice(self.items, n * (self.batch or 1)))
+        if self.batch is None:
+            return items
+        it = iter(items)
+        return list(iter(lambda: list(islice(it, self.batch)), []))
+
+    async def feed(self, engine, chunk_size=1000):
+        try:
+            while True:
+                items = await engine.offload(self._read, chunk_size)
+                if not items:
+                    return
+                for item in items:
+                    self.put_nowait(item)
+                while self.qsize() >= self.limit:
+                    self.room.clear()
+                    await self.room.wait()
+        finally:
+            self.feeding = False
@@ -0,0 +1,151 @@
+# stdlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class Frontier:
+    '''
+    Crawl state in a SQLite database (WAL mode), used to resume a crawl.
+
+    `done` holds the finished work items (search terms, package names) together with how many ids they
+    returned and how many of them were new. `ids` holds all found package names with the depth they were
+    found at. Every change goes into the open transaction right away and checkpoint() commits it, so the cost
+    of a checkpoint only depends on the work done since the last one, not on the size of the crawl.
+    '''
+
+    def __init__(self, filename, commit_every=1000, commit_interval=10):
+        self.filename = filename
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+        self.checkpoint_time = 0
+        self.checkpoints = 0
+
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS done (key TEXT PRIMARY KEY, found INTEGER, new INTEGER) WITHOUT ROWID'
+        )
+        self.db.execute('CREATE TABLE IF NOT EXISTS ids (id TEXT PRIMARY KEY, depth INTEGER) WITHOUT ROWID')
+        self.db.commit()
+
+    def is_empty(self):
+        with self.lock:
+            for _ in self.db.execute('SELECT 1 FROM done LIMIT 1'):
+                return False
+            for _ in self.db.execute('SELECT 1 FROM ids LIMIT 1'):
+                return False
+        return True
+
+    def import_json(self, filename):
+        '''
+        import a tmp file of the old json format ({"done": [...], "ids": [...]})
+        '''
+        with open(filename) as f:
+            j = json.load(f)
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO done (key) VALUES (?)', ((key,) for key in j['done']))
+            self.db.executemany('INSERT OR IGNORE INTO ids (id, depth) VALUES (?, 0)', ((i,) for i in j['ids']))
+            self.db.commit()
+
+    def add_ids(self, ids, depth=0):
+        '''
+        record found ids, an id that is known already keeps the lower depth
+        '''
+        with self.lock:
+            self.db.executemany(
+                'INSERT INTO ids (id, depth) VALUES (?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET depth = MIN(depth, excluded.depth)',
+                ((i, depth) for i in ids),
+            )
+            self.pending += len(ids)
+
+    def mark_done(self, key, found=None, new=None):
+        '''
+        record a finished work item
+        '''
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO done (key, found, new) VALUES (?, ?, ?)', (key, found, new))
+            self.pending += 1
+
+    def checkpoint(self, force=False):
+        '''
+        commit if enough changes are pending or the last commit is some time ago
+        '''
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.pending < self.commit_every and now - self.last_commit < self.commit_interval:
+                return
+            self.db.commit()
+            self.pending = 0
+            self.last_commit = time.monotonic()
+            self.checkpoint_time += self.last_commit - now
+            self.checkpoints += 1
+
+    def done(self):
+        '''
+        dict of all finished work items: key -> (found, new)
+        '''
+        with self.lock:
+            return {key: (found, new) for key, found, new in self.db.execute('SELECT key, found, new FROM done')}
+
+    def ids(self):
+        '''
+        dict of all found ids: id -> depth
+        '''
+        with self.lock:
+            return dict(self.db.execute('SELECT id, depth FROM ids'))
+
+    def _iterate(self, sql, batch):
+        with self.lock:
+            cursor = self.db.execute(sql)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(batch)
+            if not rows:
+                return
+            yield from rows
+
+    def iter_done(self, batch=10000):
+        '''
+        keys of all finished work items, fetched in batches instead of all at once
+        '''
+        for (key,) in self._iterate('SELECT key FROM done', batch):
+            yield key
+
+    def iter_ids(self, batch=10000):
+        '''
+        all found ids as (id, depth), fetched in batches instead of all at once
+        '''
+        return self._iterate('SELECT id, depth FROM ids', batch)
+
+    def export_json(self, filename):
+        '''
+        write the finished keys and the found ids to filename as {"done": [...], "ids": [...]}.
+        Only committed changes are written, the database is read with an own connection so this can run in
+        a background thread
+        '''
+        db = sqlite3.connect(self.filename)
+        try:
+            with open(filename, 'w') as f:
+                f.write('{')
+                for sep, name, sql in (('\n', 'done', 'SELECT key FROM done'), (',\n', 'ids', 'SELECT id FROM ids')):
+                    f.write(f'{sep}  "{name}": [')
+                    prefix = '\n    '
+                    for (key,) in db.execute(sql):
+                        f.write(prefix + json.dumps(key))
+                        prefix = ',\n    '
+                    f.write(']' if prefix == '\n    ' else '\n  ]')
+                f.write('\n}')
+        finally:
+            db.close()
+
+    def close(self):
+        self.checkpoint(force=True)
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,116 @@
+# stdlib
+from os import path, mkdir
+import struct
+import threading
+
+# external (optional)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Graph:
+    '''
+    Graph of related apps as compact, append-only edge list.
+
+    Package names and stream titles are interned to integers: line n of `nodes.txt` (`titles.txt`) is the
+    package (title) with the id n. `edges.bin` holds one record of three little endian uint32 per edge:
+    source, title and target. Names are written before the edges that use them, so after a crash the edge list
+    never points to unknown ids and a later run just appends to it.
+    With numpy the edges can be turned into CSR adjacency arrays (`csr.npz`).
+    '''
+
+    record = struct.Struct('<III')
+
+    def __init__(self, directory, buffer_size=1 << 16):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+
+        try:
+            mkdir(directory)
+        except FileExistsError:
+            pass
+
+        self.nodes, self.nodes_fp = self._table('nodes.txt')
+        self.titles, self.titles_fp = self._table('titles.txt')
+
+        self.edges_file = path.join(directory, 'edges.bin')
+        self.edges_fp = open(self.edges_file, 'ab')
+        # drop a half written record of a crashed run
+        size = self.edges_fp.tell()
+        if size % self.record.size:
+            self.edges_fp.truncate(size - size % self.record.size)
+
+    def _table(self, name):
+        filename = path.join(self.directory, name)
+        table = {}
+        if path.exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                for line in f:
+                    table[line.rstrip('\n')] = len(table)
+        return table, open(filename, 'a', encoding='utf-8')
+
+    @staticmethod
+    def _intern(table, fp, name):
+        i = table.get(name)
+        if i is None:
+            i = table[name] = len(table)
+            fp.write(name + '\n')
+        return i
+
+    def add(self, source, streams):
+        '''
+        add an edge from source to every id of the streams ({title: ids})
+        '''
+        with self.lock:
+            s = self._intern(self.nodes, self.nodes_fp, source)
+            for title, targets in streams.items():
+                t = self._intern(self.titles, self.titles_fp, title or '')
+                for target in targets:
+                    self.buffer += self.record.pack(s, t, self._intern(self.nodes, self.nodes_fp, target))
+            if len(self.buffer) >= self.buffer_size:
+                self._flush()
+
+    def _flush(self):
+        self.nodes_fp.flush()
+        self.titles_fp.flush()
+        self.edges_fp.write(self.buffer)
+        self.edges_fp.flush()
+        self.buffer = bytearray()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def csr(self):
+        '''
+        CSR adjacency of the graph without duplicate edges: indptr (int64, one entry per node + 1), indices
+        (targets) and titles (uint32), the edges of a source are sorted by title and target
+        '''
+        if numpy is None:
+            raise ValueError('exporting the graph needs the numpy package')
+        self.flush()
+        edges = numpy.fromfile(self.edges_file, dtype='<u4').reshape(-1, 3)
+        edges = numpy.unique(edges, axis=0)
+        indptr = numpy.zeros(len(self.nodes) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(edges[:, 0], minlength=len(self.nodes)), out=indptr[1:])
+        return indptr, numpy.ascontiguousarray(edges[:, 2]), numpy.ascontiguousarray(edges[:, 1])
+
+    def export(self):
+        '''
+        write the CSR arrays to csr.npz, returns the filename
+        '''
+        indptr, indices, titles = self.csr()
+        filename = path.join(self.directory, 'csr.npz')
+        numpy.savez(filename, indptr=indptr, indices=indices, titles=titles)
+        return filename
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.nodes_fp.close()
+            self.titles_fp.close()
+            self.edges_fp.close()
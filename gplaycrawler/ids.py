@@ -0,0 +1,283 @@
+# stdlib
+from array import array
+import hashlib
+import math
+import threading
+
+
+class IdRegistry:
+    '''
+    Package names interned in one contiguous buffer.
+
+    Every name gets an integer handle (0, 1, 2, ...) in the order it was added. The utf-8 bytes of all names
+    are concatenated in `buffer`, `offsets` holds where each one starts and an open addressing hash table of
+    handles finds the handle of a name. That is about 40 bytes per name instead of a str object plus a slot in
+    every set and dict that holds it. Sets, maps and counters over the handles are IdSet, IdMap and IdCounter.
+    '''
+
+    def __init__(self, capacity=1024):
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.offsets = array('Q', [0])
+        size = 1 << max(capacity * 2 - 1, 1).bit_length()
+        self.slots = array('i', [0]) * size
+        self.mask = size - 1
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def name(self, handle):
+        start, stop = self.offsets[handle], self.offsets[handle + 1]
+        return self.buffer[start:stop].decode()
+
+    def _slot(self, name, data):
+        '''
+        slot of name in the hash table and its handle (None if it is not known)
+        '''
+        i = hash(name) & self.mask
+        while True:
+            h = self.slots[i]
+            if h == 0:
+                return i, None
+            start, stop = self.offsets[h - 1], self.offsets[h]
+            if self.buffer[start:stop] == data:
+                return i, h - 1
+            i = (i + 1) & self.mask
+
+    def find(self, name):
+        '''
+        handle of name or None
+        '''
+        data = name.encode()
+        # _grow replaces the table, so don't look at it in between
+        with self.lock:
+            return self._slot(name, data)[1]
+
+    def intern(self, name):
+        '''
+        handle of name, name is added if it is not known
+        '''
+        data = name.encode()
+        with self.lock:
+            i, handle = self._slot(name, data)
+            if handle is not None:
+                return handle
+            handle = len(self)
+            self.buffer += data
+            self.offsets.append(len(self.buffer))
+            self.slots[i] = handle + 1
+            # at most half of the slots are used
+            if len(self) * 2 > len(self.slots):
+                self._grow()
+            return handle
+
+    def _grow(self):
+        size = len(self.slots) * 2
+        self.slots = array('i', [0]) * size
+        self.mask = size - 1
+        for handle in range(len(self)):
+            i = hash(self.name(handle)) & self.mask
+            while self.slots[i]:
+                i = (i + 1) & self.mask
+            self.slots[i] = handle + 1
+
+
+class IdSet:
+    '''
+    set of package names as bitmap over the handles of an IdRegistry.
+    Supports what the crawlers need: add, update, in, len, iteration and `names - IdSet`
+    '''
+
+    def __init__(self, registry, names=()):
+        self.registry = registry
+        self.bits = bytearray()
+        self.count = 0
+        self.update(names)
+
+    def add(self, name):
+        h = self.registry.intern(name)
+        i = h >> 3
+        if i >= len(self.bits):
+            self.bits.extend(bytes(max(i + 1 - len(self.bits), len(self.bits))))
+        bit = 1 << (h & 7)
+        if not self.bits[i] & bit:
+            self.bits[i] |= bit
+            self.count += 1
+
+    def update(self, names):
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        h = self.registry.find(name)
+        return h is not None and (h >> 3) < len(self.bits) and bool(self.bits[h >> 3] >> (h & 7) & 1)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i, byte in enumerate(self.bits):
+            if byte:
+                for b in range(8):
+                    if byte >> b & 1:
+                        yield self.registry.name(i * 8 + b)
+
+    def __rsub__(self, names):
+        return {name for name in names if name not in self}
+
+    def copy(self):
+        '''
+        IdSet with the same names, only the bitmap is copied (the registry is shared)
+        '''
+        other = IdSet(self.registry)
+        other.bits = bytearray(self.bits)
+        other.count = self.count
+        return other
+
+
+class IdMap:
+    '''
+    small integers (0-254, like depths) by package name, one byte per handle of an IdRegistry
+    '''
+
+    missing = 255
+
+    def __init__(self, registry, items=()):
+        self.registry = registry
+        self.values = bytearray()
+        self.update(items)
+
+    def __setitem__(self, name, value):
+        if not 0 <= value < self.missing:
+            raise ValueError(f'{value} does not fit into an IdMap')
+        h = self.registry.intern(name)
+        if h >= len(self.values):
+            self.values.extend(bytes([self.missing]) * max(h + 1 - len(self.values), len(self.values)))
+        self.values[h] = value
+
+    def update(self, items):
+        if isinstance(items, dict):
+            items = items.items()
+        for name, value in items:
+            self[name] = value
+
+    def get(self, name, default=None):
+        h = self.registry.find(name)
+        if h is None or h >= len(self.values) or self.values[h] == self.missing:
+            return default
+        return self.values[h]
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def items(self):
+        for h, value in enumerate(self.values):
+            if value != self.missing:
+                yield self.registry.name(h), value
+
+
+class IdCounter:
+    '''
+    counts by package name (like in-degrees), one 32 bit counter per handle of an IdRegistry
+    '''
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.counts = array('I')
+
+    def __getitem__(self, name):
+        h = self.registry.find(name)
+        if h is None or h >= len(self.counts):
+            return 0
+        return self.counts[h]
+
+    def increment(self, name):
+        '''
+        count name once more, returns the new count
+        '''
+        h = self.registry.intern(name)
+        if h >= len(self.counts):
+            self.counts.extend(array('I', [0]) * max(h + 1 - len(self.counts), len(self.counts)))
+        self.counts[h] += 1
+        return self.counts[h]
+
+
+class CountMinSketch:
+    '''
+    approximate counts by package name in fixed memory (like in-degrees with Bloom filters): `depth` rows of
+    `width` 16 bit counters. A name is counted in one counter per row and its count is the lowest of them,
+    never less than the real count (up to 65535, where the counters stop)
+    '''
+
+    def __init__(self, width, depth=2):
+        self.width = max(width, 1)
+        self.depth = depth
+        self.counts = array('H', [0]) * (self.width * depth)
+
+    def _positions(self, name):
+        # double hashing like BloomFilter, one counter in every row
+        d = hashlib.blake2b(name.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(d[:8], 'little')
+        h2 = int.from_bytes(d[8:], 'little') | 1
+        return [i * self.width + (h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def __getitem__(self, name):
+        return min(self.counts[p] for p in self._positions(name))
+
+    def increment(self, name):
+        '''
+        count name once more, returns the new count. Only the lowest counters are raised (conservative update)
+        '''
+        positions = self._positions(name)
+        n = min(min(self.counts[p] for p in positions) + 1, 0xFFFF)
+        for p in positions:
+            if self.counts[p] < n:
+                self.counts[p] = n
+        return n
+
+
+class BloomFilter:
+    '''
+    Approximate set of package names for "seen" checks. A name that was added is always found, a name that
+    was not added is found with probability `error_rate` (up to `capacity` names). Needs about
+    1.44 * log2(1 / error_rate) bits per name, but names can't be listed again
+    '''
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, name):
+        # double hashing with two 64 bit halves of one digest
+        d = hashlib.blake2b(name.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(d[:8], 'little')
+        h2 = int.from_bytes(d[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, name):
+        new = False
+        for p in self._positions(name):
+            bit = 1 << (p & 7)
+            if not self.bits[p >> 3] & bit:
+                self.bits[p >> 3] |= bit
+                new = True
+        if new:
+            self.count += 1
+
+    def update(self, names):
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        return all(self.bits[p >> 3] >> (p & 7) & 1 for p in self._positions(name))
+
+    def __len__(self):
+        '''
+        number of names added (names that were false positives are not counted)
+        '''
+        return self.count
+
+    def __rsub__(self, names):
+        return {name for name in names if name not in self}
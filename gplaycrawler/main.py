@@ -3,6 +3,8 @@ from argparse import ArgumentParser, HelpFormatter
 from importlib.metadata import metadata
 
 # internal
+from gplaycrawler.aio import AsyncEngine
+from gplaycrawler.bench import Bench, commands
 from gplaycrawler.related import Related
 from gplaycrawler.search import Search
 from gplaycrawler.metadata import Metadata
@@ -39,11 +41,26 @@ def main():
     parent_parser.add_argument('--timezone', default='UTC', help='(default: %(default)s)')
     parent_parser.add_argument('--device', default='px_3a', help='(default: %(default)s)')
     parent_parser.add_argument(
-        '--delay', default=0.51, help='Delay between every request in seconds (default: %(default)s)', type=float
+        '--delay',
+        default=0.51,
+        help='Initial delay between requests of all workers in seconds, adapts to rate limits (default: %(default)s)',
+        type=float,
     )
     parent_parser.add_argument(
         '--threads', default=2, help='Number of parallel workers (default: %(default)s)', type=int
     )
+    parent_parser.add_argument(
+        '--engine',
+        default='threads',
+        help='Run workers as threads or on an asyncio event loop (default: %(default)s)',
+        choices=['threads', 'async'],
+    )
+    parent_parser.add_argument(
+        '--concurrency',
+        default=64,
+        help='Maximum number of requests in flight with --engine async (default: %(default)s)',
+        type=int,
+    )
 
     # Subparsers based on parent
 
@@ -63,6 +80,24 @@ def main():
     parser_search.add_argument(
         '--length', default=2, help='length of strings to search (default: %(default)s)', type=int
     )
+    parser_search.add_argument(
+        '--adaptive',
+        help='start with single characters and only expand prefixes with many or new results, up to --length',
+        action='store_true',
+    )
+    parser_search.add_argument(
+        '--alphabets',
+        help='alphabets of chars.json to build search strings from, e.g. latin digits cyrillic cjk (default: latin)',
+        default=['latin'],
+        nargs='+',
+        metavar='ALPHABET',
+    )
+    parser_search.add_argument(
+        '--locales',
+        help='search in all of these locales, all ids go into one output file (default: --locale)',
+        nargs='+',
+        metavar='LOCALE',
+    )
 
     # related
     d = 'parallel searching of apps via related apps'
@@ -73,6 +108,40 @@ def main():
         '--output', help='base name of the output files (default: %(default)s)', default='ids_related'
     )
     parser_related.add_argument('--level', default=3, help='How deep to crawl (default: %(default)s)', type=int)
+    parser_related.add_argument(
+        '--cache-size',
+        default=10000,
+        help='number of streams to keep the further pages of in memory (default: %(default)s)',
+        type=int,
+    )
+    parser_related.add_argument(
+        '--cache-file', help='also keep the stream cache in this database, to reuse it in later runs', metavar='FILE'
+    )
+    parser_related.add_argument(
+        '--order',
+        help='order within a level: as found or the apps most other apps link to first (default: %(default)s)',
+        choices=['depth', 'popularity'],
+        default='depth',
+    )
+    parser_related.add_argument(
+        '--queue-size',
+        help='apps to keep in memory with --order popularity, the rest waits on disk (default: %(default)s)',
+        default=100000,
+        type=int,
+    )
+    parser_related.add_argument(
+        '--graph',
+        help='write the edges (app, stream title, related app) as binary edge list to DIR, '
+        'with numpy also as CSR arrays (default: off)',
+        metavar='DIR',
+    )
+    parser_related.add_argument(
+        '--bloom',
+        help='keep the known ids only in Bloom filters sized for N ids (about 2 bytes per id, 4 with --order '
+        'popularity, a few ids can be missed) and write the output from the frontier (default: off)',
+        type=int,
+        metavar='N',
+    )
 
     # metadata
     d = 'parallel scraping of app metadata'
@@ -84,6 +153,26 @@ def main():
     parser_metadata.add_argument(
         '--output', help='directory name of the output files (default: %(default)s)', default='out_metadata'
     )
+    parser_metadata.add_argument(
+        '--bulk', help='get the details of N apps with one bulkDetails request (default: off)', type=int, metavar='N'
+    )
+    parser_metadata.add_argument(
+        '--format',
+        help='one json file per app or compressed jsonl shards with an index (default: %(default)s)',
+        choices=['files', 'shards'],
+        default='files',
+    )
+    parser_metadata.add_argument(
+        '--compression',
+        help='compression of the shards, zstd needs the zstandard package (default: %(default)s)',
+        choices=['gzip', 'zstd'],
+        default='gzip',
+    )
+    parser_metadata.add_argument(
+        '--refresh',
+        help='check stored apps for a new versionCode or uploadDate and get changed ones again',
+        action='store_true',
+    )
     # packages
     d = 'parallel downloading app packages'
     parser_packages = subparsers.add_parser(
@@ -100,6 +189,126 @@ def main():
     parser_packages.add_argument(
         '--splits', help='also download split files (default: %(default)s)', action='store_true'
     )
+    parser_packages.add_argument(
+        '--parts', help='parallel range requests per file (default: %(default)s)', default=4, type=int
+    )
+    parser_packages.add_argument(
+        '--budget',
+        help='parallel requests per package, shared by its apk, expansion files and splits (default: %(default)s)',
+        default=8,
+        type=int,
+    )
+    parser_packages.add_argument(
+        '--storage',
+        help='plain files or content addressed blobs with a manifest per version (default: %(default)s)',
+        choices=['files', 'blobs'],
+        default='files',
+    )
+    parser_packages.add_argument(
+        '--metadata',
+        help='output directory of the metadata command, apps it expects to be large get their own workers '
+        '(default: off)',
+        metavar='DIR',
+    )
+    parser_packages.add_argument(
+        '--large-size',
+        help='apps of at least this many MB are large (default: %(default)s)',
+        default=100,
+        type=float,
+        metavar='MB',
+    )
+    parser_packages.add_argument(
+        '--large-threads',
+        help='workers for large apps, in addition to --threads (default: %(default)s)',
+        default=1,
+        type=int,
+    )
+    parser_packages.add_argument(
+        '--bandwidth',
+        help='maximum download rate of all workers together in MB/s (default: unlimited)',
+        type=float,
+        metavar='MB/S',
+    )
+    parser_packages.add_argument(
+        '--mirror',
+        help='download stored packages again when they have a new versionCode, uses blob storage '
+        '(default: %(default)s)',
+        action='store_true',
+    )
+    parser_packages.add_argument(
+        '--keep',
+        help='old versions kept per package with --mirror, unused blobs are deleted (default: %(default)s)',
+        default=1,
+        type=int,
+    )
+    parser_packages.add_argument(
+        '--analyze',
+        help='analyze the downloaded packages with these comma separated analyzers: manifest, native, '
+        'signatures or module:function (default: off)',
+        metavar='ANALYZERS',
+    )
+    parser_packages.add_argument('--processes', help='processes for the analysis (default: number of CPUs)', type=int)
+    parser_packages.add_argument(
+        '--backlog',
+        help='packages that can wait for the analysis before downloads pause (default: %(default)s)',
+        default=100,
+        type=int,
+    )
+
+    # bench
+    d = 'measure the commands against a local stand-in for the Play Store'
+    parser_bench = subparsers.add_parser('bench', help=d, description=d, formatter_class=F)
+    parser_bench.add_argument(
+        '--commands',
+        help=f'commands to run: {", ".join(commands)} (default: all)',
+        choices=commands,
+        default=commands,
+        nargs='+',
+        metavar='COMMAND',
+    )
+    parser_bench.add_argument(
+        '--threads', help='numbers of workers to try (default: 1 4 16)', default=[1, 4, 16], type=int, nargs='+'
+    )
+    parser_bench.add_argument(
+        '--engines',
+        help='engines to try: threads, async (default: threads)',
+        choices=['threads', 'async'],
+        default=['threads'],
+        nargs='+',
+        metavar='ENGINE',
+    )
+    parser_bench.add_argument(
+        '--concurrency', help='requests in flight with the async engine (default: %(default)s)', default=64, type=int
+    )
+    parser_bench.add_argument(
+        '--delay', help='initial delay between requests in seconds (default: unlimited)', default=None, type=float
+    )
+    parser_bench.add_argument('--latency', help='seconds per request (default: %(default)s)', default=0.02, type=float)
+    parser_bench.add_argument(
+        '--server-rate', help='requests per second before 429 (default: unlimited)', default=None, type=float
+    )
+    parser_bench.add_argument(
+        '--error-rate', help='share of requests answered with 429 (default: %(default)s)', default=0, type=float
+    )
+    parser_bench.add_argument('--apps', help='number of distinct apps (default: %(default)s)', default=10000, type=int)
+    parser_bench.add_argument('--pages', help='pages per list (default: %(default)s)', default=3, type=int)
+    parser_bench.add_argument('--page-size', help='ids per page (default: %(default)s)', default=20, type=int)
+    parser_bench.add_argument(
+        '--items', help='input ids for related, metadata and packages (default: %(default)s)', default=200, type=int
+    )
+    parser_bench.add_argument('--length', help='length of search strings (default: %(default)s)', default=1, type=int)
+    parser_bench.add_argument('--adaptive', help='adaptive search up to --length', action='store_true')
+    parser_bench.add_argument(
+        '--level', help='levels of related after the input (default: %(default)s)', default=0, type=int
+    )
+    parser_bench.add_argument('--bulk', help='bulk size for metadata (default: off)', default=None, type=int)
+    parser_bench.add_argument(
+        '--apk-size', help='size of served packages in bytes (default: %(default)s)', default=1 << 20, type=int
+    )
+    parser_bench.add_argument(
+        '--timeout', help='seconds before a run is stopped (default: %(default)s)', default=600, type=float
+    )
+    parser_bench.add_argument('--output', help='also write the results to this json file', default=None)
 
     args = parser.parse_args()
 
@@ -112,7 +321,16 @@ def main():
         print('\n\nAll commands in detail:')
 
         parentsubparsers = [parser_charts, parser_search, parser_related, parser_metadata, parser_packages]
-        commonargs = ['-h, --help', '--locale', '--timezone', '--device', '--delay', '--threads']
+        commonargs = [
+            '-h, --help',
+            '--locale',
+            '--timezone',
+            '--device',
+            '--delay',
+            '--threads',
+            '--engine',
+            '--concurrency',
+        ]
         parentsubparsers_str = []
         for p in parentsubparsers:
             parentsubparsers_str.append(p.prog.split(' ')[1])
@@ -131,33 +349,108 @@ def main():
                     hn += line + '\n'
             hn = hn.rstrip('optional arguments:\n')
             print(f"\n\n{p_str}:\n{hn}")
+        print(f"\n\nbench:\n{parser_bench.format_help()}")
         exit()
 
+    engine = None
+    if getattr(args, 'engine', None) == 'async':
+        engine = AsyncEngine(concurrency=args.concurrency, log_level=args.verbosity)
+
     if args.command == 'charts':
         c = Charts(
             locale=args.locale, timezone=args.timezone, device=args.device, delay=args.delay, log_level=args.verbosity
         )
+        if engine is not None:
+            # there are only 8 charts, every one of them is paged through by a thread of its own
+            c.log.warning('charts always runs one thread per chart, --engine async is ignored')
         c.getCharts(args.output)
     elif args.command == 'search':
         s = Search(
             locale=args.locale, timezone=args.timezone, device=args.device, delay=args.delay, log_level=args.verbosity
         )
-        s.getSearch(args.output, args.threads, args.length)
+        s.getSearch(
+            args.output,
+            args.threads,
+            args.length,
+            engine=engine,
+            adaptive=args.adaptive,
+            alphabets=args.alphabets,
+            locales=args.locales,
+        )
     elif args.command == 'related':
         r = Related(
             locale=args.locale, timezone=args.timezone, device=args.device, delay=args.delay, log_level=args.verbosity
         )
-        r.getRelated(args.input, args.output, until_level=args.level, threads=args.threads)
+        r.getRelated(
+            args.input,
+            args.output,
+            until_level=args.level,
+            threads=args.threads,
+            engine=engine,
+            cache_size=args.cache_size,
+            cache_file=args.cache_file,
+            graph=args.graph,
+            order=args.order,
+            queue_size=args.queue_size,
+            bloom=args.bloom,
+        )
     elif args.command == 'metadata':
         m = Metadata(
             locale=args.locale, timezone=args.timezone, device=args.device, delay=args.delay, log_level=args.verbosity
         )
-        m.getMetadata(args.input, args.output, args.threads)
+        m.getMetadata(
+            args.input,
+            args.output,
+            args.threads,
+            engine=engine,
+            bulk=args.bulk,
+            fmt=args.format,
+            compression=args.compression,
+            refresh=args.refresh,
+        )
+    elif args.command == 'bench':
+        options = {
+            'delay': args.delay,
+            'concurrency': args.concurrency,
+            'latency': args.latency,
+            'server_rate': args.server_rate,
+            'error_rate': args.error_rate,
+            'apps': args.apps,
+            'pages': args.pages,
+            'page_size': args.page_size,
+            'items': args.items,
+            'length': args.length,
+            'adaptive': args.adaptive,
+            'level': args.level,
+            'bulk': args.bulk,
+            'apk_size': args.apk_size,
+        }
+        b = Bench(log_level=args.verbosity)
+        b.getBench(args.commands, args.threads, args.engines, options, out_file=args.output, timeout=args.timeout)
     elif args.command == 'packages':
         p = Packages(
             locale=args.locale, timezone=args.timezone, device=args.device, delay=args.delay, log_level=args.verbosity
         )
-        p.getPackages(args.input, args.output, args.threads, args.expansions, args.splits)
+        p.getPackages(
+            args.input,
+            args.output,
+            args.threads,
+            args.expansions,
+            args.splits,
+            engine=engine,
+            parts=args.parts,
+            budget=args.budget,
+            storage=args.storage,
+            metadata=args.metadata,
+            large_size=int(args.large_size * 1024 * 1024),
+            large_threads=args.large_threads,
+            bandwidth=None if args.bandwidth is None else args.bandwidth * 1024 * 1024,
+            mirror=args.mirror,
+            keep=args.keep,
+            analyzers=None if args.analyze is None else args.analyze.split(','),
+            processes=args.processes,
+            backlog=args.backlog,
+        )
 
     else:
         parser.print_help()
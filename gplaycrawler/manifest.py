@@ -0,0 +1,91 @@
+# stdlib
+from os import path, mkdir, replace
+import json
+import threading
+import time
+
+
+class Manifest:
+    '''
+    Append-only record of the finished items of an output directory, to resume without listing it.
+
+    `manifest.jsonl` holds one line per finished item:
+    {"package": ..., "time": ..., "options": [...], "files": {name: {"size": ..., "sha256": ...}}}.
+    options are the settings the item was fetched with (like splits), a later entry of a package replaces
+    the earlier ones. A line that was cut off by a crash is ignored, so its item is fetched again.
+    Only package and options are kept in memory.
+    Without a manifest, rebuild() (returns (package, files, options) tuples) is used once to create it
+    from the files of an older run.
+    '''
+
+    def __init__(self, directory, rebuild=None, filename='manifest.jsonl'):
+        self.lock = threading.Lock()
+        self.entries = {}
+        # one shared frozenset per combination of options
+        self.options = {}
+
+        try:
+            mkdir(directory)
+        except FileExistsError:
+            pass
+
+        self.filename = path.join(directory, filename)
+        if path.exists(self.filename):
+            size = 0
+            with open(self.filename, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    size += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry['package']] = self._options(entry.get('options', ()))
+            # drop a half written line of a crashed run
+            if size != path.getsize(self.filename):
+                with open(self.filename, 'r+b') as f:
+                    f.truncate(size)
+        elif rebuild is not None:
+            with open(self.filename + '.tmp', 'w', encoding='utf-8') as f:
+                for package, files, options in rebuild():
+                    f.write(self._line(package, files, options))
+                    self.entries[package] = self._options(options)
+            replace(self.filename + '.tmp', self.filename)
+        self.fp = open(self.filename, 'a', encoding='utf-8')
+
+    def _options(self, options):
+        options = frozenset(options)
+        return self.options.setdefault(options, options)
+
+    @staticmethod
+    def _line(package, files, options):
+        entry = {'package': package, 'time': int(time.time()), 'options': sorted(options), 'files': files}
+        return json.dumps(entry, separators=(',', ':')) + '\n'
+
+    def add(self, package, files, options=()):
+        '''
+        record a finished item, files: dict file name -> {'size': ..., 'sha256': ...}
+        '''
+        line = self._line(package, files, options)
+        with self.lock:
+            self.fp.write(line)
+            self.fp.flush()
+            self.entries[package] = self._options(options)
+
+    def __contains__(self, package):
+        return package in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def packages(self, options=()):
+        '''
+        set of the finished packages that were fetched with all of options
+        '''
+        options = frozenset(options)
+        return {package for package, o in self.entries.items() if options <= o}
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
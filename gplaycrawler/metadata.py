@@ -1,12 +1,20 @@
-from os import path, mkdir, walk
-from requests.exceptions import HTTPError, ReadTimeout
+from itertools import chain
+from os import path, mkdir, scandir, replace
+from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
+import asyncio
+import hashlib
 import json
 import queue
 import threading
 import time
 
-from playstoreapi.googleplay import GooglePlayAPI, LoginError
-from gplaycrawler.utils import get_logger
+from playstoreapi.googleplay import RequestError
+from gplaycrawler.feed import AsyncFeedQueue, FeedQueue, read_ids, unique
+from gplaycrawler.manifest import Manifest
+from gplaycrawler.ratelimit import get_limiter
+from gplaycrawler.session import Backoff, SessionPool
+from gplaycrawler.store import ShardStore
+from gplaycrawler.utils import get_logger, strip_suffix
 
 
 class Metadata:
@@ -15,6 +23,7 @@ class Metadata:
         self.timezone = timezone
         self.device = device
         self.delay = delay
+        self.limiter = get_limiter(delay)
 
         self.log_level = log_level
         self.log = get_logger(log_level, name=__name__)
@@ -25,122 +34,422 @@ class Metadata:
         else:
             self.quiet = True
 
-    def worker(self, api, q, done_ids, out_dir, threads):
-        while not q.empty():
-            packageName = q.get_nowait()  # non blocking
-            self.log.debug(f'Start getting metadata for "{packageName}"')
+        self.pool = SessionPool(locale, timezone, device, limiter=self.limiter, quiet=self.quiet, log=self.log)
+        self.store = None
+        self.manifest = None
+
+    @staticmethod
+    def version(result):
+        '''
+        (versionCode, uploadDate) of a details or bulkDetails result
+        '''
+        appDetails = result.get('details', {}).get('appDetails', {})
+        return appDetails.get('versionCode'), appDetails.get('uploadDate')
+
+    def load(self, packageName, out_dir):
+        '''
+        stored details of packageName or None
+        '''
+        if self.store is not None:
+            record = self.store.get(packageName)
+            return None if record is None else record['details']
+        try:
+            with open(path.join(out_dir, packageName + '.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
 
+    def save(self, result, packageName, out_dir):
+        if self.store is not None:
+            # older revisions stay in the shards, the index points to the latest one
+            self.store.put(packageName, result)
+            return
+        filepath = path.join(out_dir, packageName + '.json')
+        if path.exists(filepath):
+            # keep the previous revision
+            versionCode, _ = self.version(self.load(packageName, out_dir) or {})
+            revisions = path.join(out_dir, 'revisions')
             try:
-                result = api.details(packageName)
+                mkdir(revisions)
+            except FileExistsError:
+                pass
+            replace(filepath, path.join(revisions, f'{packageName}-{versionCode or int(time.time())}.json'))
+        data = json.dumps(result, indent=2).encode()
+        with open(filepath, 'wb') as f:
+            f.write(data)
+        if self.manifest is not None:
+            name = path.basename(filepath)
+            self.manifest.add(packageName, {name: {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}})
+
+    @staticmethod
+    def rebuild(out_dir):
+        '''
+        manifest entries of the json files of an older run (without hashes)
+        '''
+        with scandir(out_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith('.json'):
+                    files = {entry.name: {'size': entry.stat().st_size, 'sha256': None}}
+                    yield strip_suffix(entry.name, '.json'), files, ()
+
+    def changed(self, api, packageNames, out_dir):
+        '''
+        compare versionCode and uploadDate of the stored details with a bulk lookup.
+        Returns dict packageName -> bulkDetails result of the apps that changed
+        '''
+        results = self.bulkDetails(api, packageNames)
+        changed = {}
+        for packageName, result in results.items():
+            new = self.version(result)
+            if new[0] is None:
+                # no version in the response, can't tell
+                continue
+            if self.version(self.load(packageName, out_dir) or {}) != new:
+                changed[packageName] = result
+        return changed
+
+    def checkWorker(self, q, changed, out_dir, bulk):
+        '''
+        refresh: find the apps that changed since they were stored, `bulk` apps per request
+        '''
+        api = self.pool.get()
+        backoff = Backoff()
+        while True:
+            try:
+                batch = [q.get(timeout=1)]
+            except queue.Empty:
+                # items can still be added back by other workers
+                if q.unfinished_tasks == 0:
+                    break
+                continue
+            while len(batch) < bulk:
+                try:
+                    batch.append(q.get_nowait())  # non blocking
+                except queue.Empty:
+                    break
+
+            # every item of the batch is finished, whatever happens, or the workers never stop
+            try:
+                changed.update(self.changed(api, batch, out_dir))
+                backoff.reset()
+                self.log.info(f'Changed: {len(changed)}, to check: {q.qsize()}')
             except HTTPError as e:
                 if e.response.status_code == 429 or e.response.status_code == 401:
                     if e.response.status_code == 401:
                         self.log.warning('Unauthorized. Trying relogin...')
                     else:
                         self.log.warning('metadata got rate limited')
-                    api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-                    while True:
-                        try:
-                            api.envLogin(quiet=self.quiet, check=False)
-                        except LoginError:
-                            self.log.info('Login failed. Retry in 3 minutes')
-                            time.sleep(180)
-                        else:
-                            break
-                    self.log.debug('new api, logged in, try again')
+                        backoff.sleep()
+                    api = self.pool.relogin()
+                    for packageName in batch:
+                        q.put_nowait(packageName)
                 else:
                     self.log.warning(str(e))
-                continue
-            except ReadTimeout:
-                self.log.debug(f'Request did timeout (worker), add back {packageName}')
-                q.put_nowait(packageName)
-                q.task_done()
-                continue
-
-            filepath = path.join(out_dir, packageName + '.json')
-            with open(filepath, 'w') as f:
-                json.dump(result, f, indent=2)
-
-            q.task_done()
-            self.log.info(f'Done: {len(done_ids)}, to do: {q.qsize()}')
-            done_ids.add(packageName)
+            except (ReadTimeout, ConnectionError) as e:
+                self.log.debug(f'{type(e).__name__} (worker), add back {len(batch)} packages')
+                if isinstance(e, ConnectionError):
+                    backoff.sleep()
+                for packageName in batch:
+                    q.put_nowait(packageName)
+            except Exception as e:
+                self.log.warning(f'{len(batch)} packages failed: {type(e).__name__}: {str(e)}')
+            finally:
+                for _ in batch:
+                    q.task_done()
 
         t = threading.current_thread()
         self.log.info(f'{t.name} finished. Queue empty')
         t.done = True
         return
 
-    def getMetadata(self, in_file, out_dir, num_threads):
-        ids = set()
-
-        try:
-            with open(in_file) as f:
-                j = json.load(f)
-        except FileNotFoundError:
-            self.log.error('Input file not found')
-            return
-
-        if type(j) == list:
-            ids.update(j)
-        else:
-            try:
-                ids.update(j['done'])
-                ids.update(j['ids'])
-            except KeyError:
-                self.log.error('Input file is in unknown format')
-
-        # load ids that are already done via amp
-        try:
-            (_, _, done_filenames) = next(walk(out_dir))
-        except StopIteration:
-            done_filenames = []
-
-        ids_done = set()
-        for file in set(done_filenames):
-            ids_done.add(file.rstrip('.json'))
+    async def asyncCheck(self, engine, q, changed, out_dir, bulk):
+        '''
+        same as checkWorker but running on the event loop of engine
+        '''
+        aq = asyncio.Queue()
+        batch = []
+        while not q.empty():
+            batch.append(q.get_nowait())
+            if len(batch) == bulk or q.empty():
+                aq.put_nowait(batch)
+                batch = []
 
-        todo_ids = ids - ids_done
-        q = queue.Queue()
-        for packageName in todo_ids:
-            q.put_nowait(packageName)
+        async def handler(batch):
+            changed.update(await engine.request(self.changed, batch, out_dir))
+            self.log.info(f'Changed: {len(changed)}, to check: {aq.qsize() * bulk}')
 
-        self.log.info(f'Done: {len(ids_done)}, to do: {q.qsize()}')
-        try:
-            mkdir(out_dir)
-        except FileExistsError:
-            pass
+        await engine.drain(aq, handler)
 
+    def runWorkers(self, num_threads, target, args):
+        '''
+        run num_threads threads of target(*args) and replace the ones that crash until all are done
+        '''
         i = 0
         threads = []
         while num_threads > 0:
             while len(threads) < num_threads:
-                api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-                while True:
-                    try:
-                        api.envLogin(quiet=self.quiet, check=False)
-                    except LoginError:
-                        self.log.info('Login failed. Retry in 3 minutes')
-                        time.sleep(180)
-                    else:
-                        break
-                t = threading.Thread(target=self.worker, args=(api, q, ids_done, out_dir, threads))
+                t = threading.Thread(target=target, args=args)
                 i += 1
                 t.name = f'Worker-{i}'
                 t.done = False
                 threads.append(t)
                 t.start()
                 self.log.info(f'Started {t.name}')
-                # wait 10-11 min to start next thread
-                # time.sleep(60 * 10 + random() * 60)
 
-            for t in threads:
+            for t in list(threads):
                 t.join(timeout=1)
                 if not t.is_alive():
+                    threads.remove(t)
                     if t.done:
                         num_threads -= 1
                     else:
-                        threads.remove(t)
                         self.log.info(f'Worker {t.name} crashed. Starting a new worker')
                         time.sleep(1)
 
-        self.log.info('Threads finished')
+    def bulkDetails(self, api, packageNames):
+        '''
+        get details of packageNames with bulkDetails, returns dict packageName -> details.
+        A batch that fails as a whole is split in halves, packages missing in the response are
+        fetched one by one with details. Rate limiting and timeouts are left to the caller
+        '''
+        try:
+            docs = api.bulkDetails(packageNames)
+        except (HTTPError, RequestError) as e:
+            if isinstance(e, HTTPError) and e.response.status_code in (401, 429):
+                raise
+            if len(packageNames) == 1:
+                docs = [None]
+            else:
+                self.log.debug(f'Batch of {len(packageNames)} failed ({str(e)}), splitting it')
+                half = len(packageNames) // 2
+                results = self.bulkDetails(api, packageNames[:half])
+                results.update(self.bulkDetails(api, packageNames[half:]))
+                return results
+
+        results = {}
+        for packageName, doc in zip(packageNames, docs):
+            if doc is not None:
+                results[packageName] = doc
+        missing = [p for p in packageNames if p not in results]
+        if missing:
+            self.log.debug(f'{len(missing)} of {len(packageNames)} missing in bulk response, retry one by one')
+        for packageName in missing:
+            try:
+                results[packageName] = api.details(packageName)
+            except RequestError as e:
+                self.log.warning(f'{packageName}: {str(e)}')
+        return results
+
+    def bulkWorker(self, q, done_ids, out_dir, bulk):
+        '''
+        like worker, but fetches up to `bulk` packages with one request
+        '''
+        api = self.pool.get()
+        backoff = Backoff()
+        while True:
+            try:
+                batch = [q.get(timeout=1)]
+            except queue.Empty:
+                # the feeder can still add ids
+                if q.unfinished_tasks == 0:
+                    break
+                continue
+            while len(batch) < bulk:
+                try:
+                    batch.append(q.get_nowait())  # non blocking
+                except queue.Empty:
+                    break
+            self.log.debug(f'Start getting metadata for {len(batch)} packages')
+
+            # every item of the batch is finished, whatever happens, or the workers never stop
+            try:
+                results = self.bulkDetails(api, batch)
+                backoff.reset()
+                for packageName, result in results.items():
+                    self.save(result, packageName, out_dir)
+                    done_ids.add(packageName)
+                self.log.info(f'Done: {len(done_ids)}, to do: {q.qsize()}')
+            except HTTPError as e:
+                if e.response.status_code == 429 or e.response.status_code == 401:
+                    if e.response.status_code == 401:
+                        self.log.warning('Unauthorized. Trying relogin...')
+                    else:
+                        self.log.warning('metadata got rate limited')
+                        backoff.sleep()
+                    api = self.pool.relogin()
+                    self.log.debug(f'new api, logged in, add back {len(batch)} packages')
+                    for packageName in batch:
+                        q.put_nowait(packageName)
+                else:
+                    self.log.warning(str(e))
+            except (ReadTimeout, ConnectionError) as e:
+                self.log.debug(f'{type(e).__name__} (worker), add back {len(batch)} packages')
+                if isinstance(e, ConnectionError):
+                    backoff.sleep()
+                for packageName in batch:
+                    q.put_nowait(packageName)
+            except Exception as e:
+                self.log.warning(f'{len(batch)} packages failed: {type(e).__name__}: {str(e)}')
+            finally:
+                for _ in batch:
+                    q.task_done()
+
+        t = threading.current_thread()
+        self.log.info(f'{t.name} finished. Queue empty')
+        t.done = True
+        return
+
+    def worker(self, q, done_ids, out_dir, threads):
+        api = self.pool.get()
+        backoff = Backoff()
+        while True:
+            try:
+                packageName = q.get(timeout=1)
+            except queue.Empty:
+                # the feeder can still add ids
+                if q.unfinished_tasks == 0:
+                    break
+                continue
+            self.log.debug(f'Start getting metadata for "{packageName}"')
+
+            # the item is finished, whatever happens, or the workers never stop
+            try:
+                result = api.details(packageName)
+                backoff.reset()
+                self.save(result, packageName, out_dir)
+                self.log.info(f'Done: {len(done_ids)}, to do: {q.qsize()}')
+                done_ids.add(packageName)
+            except RequestError as e:
+                self.log.warning(f'{packageName}: {str(e)}')
+            except HTTPError as e:
+                if e.response.status_code == 429 or e.response.status_code == 401:
+                    if e.response.status_code == 401:
+                        self.log.warning('Unauthorized. Trying relogin...')
+                    else:
+                        self.log.warning('metadata got rate limited')
+                        backoff.sleep()
+                    api = self.pool.relogin()
+                    self.log.debug(f'new api, logged in, add back {packageName}')
+                    q.put_nowait(packageName)
+                else:
+                    self.log.warning(str(e))
+            except (ReadTimeout, ConnectionError) as e:
+                self.log.debug(f'{type(e).__name__} (worker), add back {packageName}')
+                if isinstance(e, ConnectionError):
+                    backoff.sleep()
+                q.put_nowait(packageName)
+            except Exception as e:
+                self.log.warning(f'{packageName}: {type(e).__name__}: {str(e)}')
+            finally:
+                q.task_done()
+
+        t = threading.current_thread()
+        self.log.info(f'{t.name} finished. Queue empty')
+        t.done = True
+        return
+
+    async def asyncMetadata(self, engine, q, done_ids, out_dir, bulk=None):
+        '''
+        same as worker (or bulkWorker) but running on the event loop of engine,
+        the ids of the FeedQueue q are read from there
+        '''
+        aq = AsyncFeedQueue(q.items, q.limit, batch=bulk)
+        feeder = asyncio.ensure_future(aq.feed(engine))
+
+        async def bulkHandler(batch):
+            self.log.debug(f'Start getting metadata for {len(batch)} packages')
+            results = await engine.request(self.bulkDetails, batch)
+            for packageName, result in results.items():
+                self.save(result, packageName, out_dir)
+                done_ids.add(packageName)
+            self.log.info(f'Done: {len(done_ids)}, to do: {aq.qsize() * bulk}')
+
+        async def handler(packageName):
+            self.log.debug(f'Start getting metadata for "{packageName}"')
+            try:
+                result = await engine.request('details', packageName)
+            except RequestError as e:
+                self.log.warning(f'{packageName}: {str(e)}')
+                return
+
+            self.save(result, packageName, out_dir)
+
+            self.log.info(f'Done: {len(done_ids)}, to do: {aq.qsize()}')
+            done_ids.add(packageName)
+
+        if bulk is None:
+            await engine.drain(aq, handler)
+        else:
+            await engine.drain(aq, bulkHandler)
+        await feeder
+
+    def getMetadata(
+        self, in_file, out_dir, num_threads, engine=None, bulk=None, fmt='files', compression='gzip', refresh=False
+    ):
+        # the input is read while the workers run
+        try:
+            ids = read_ids(in_file)
+        except FileNotFoundError:
+            self.log.error('Input file not found')
+            return
+
+        if fmt == 'shards':
+            try:
+                self.store = ShardStore(out_dir, compression=compression)
+            except ValueError as e:
+                self.log.error(str(e))
+                return
+            ids_done = self.store.packages()
+        else:
+            # finished apps are in the manifest, the directory is only listed if there is none yet
+            self.manifest = Manifest(out_dir, rebuild=lambda: self.rebuild(out_dir))
+            ids_done = self.manifest.packages()
+
+        try:
+            mkdir(out_dir)
+        except FileExistsError:
+            pass
+
+        todo_ids = unique(ids, ids_done)
+        if refresh:
+            q = queue.Queue()
+            for packageName in unique(read_ids(in_file)):
+                if packageName in ids_done:
+                    q.put_nowait(packageName)
+            self.log.info(f'Checking {q.qsize()} stored apps for new versions')
+
+            changed = {}
+            check_bulk = bulk or 100
+            if engine is not None:
+                engine.run(self.pool, self.asyncCheck, engine, q, changed, out_dir, check_bulk)
+            else:
+                self.runWorkers(num_threads, self.checkWorker, (q, changed, out_dir, check_bulk))
+            self.log.info(f'{len(changed)} apps changed')
+
+            if bulk is None:
+                # the bulk response is not the full details, get them again
+                todo_ids = chain(todo_ids, changed)
+            else:
+                for packageName, result in changed.items():
+                    self.save(result, packageName, out_dir)
+
+        q = FeedQueue(todo_ids)
+
+        self.log.info(f'Done: {len(ids_done)}, reading the ids to do from {in_file}')
+
+        if engine is not None:
+            engine.run(self.pool, self.asyncMetadata, engine, q, ids_done, out_dir, bulk)
+        elif bulk is None:
+            q.start()
+            self.runWorkers(num_threads, self.worker, (q, ids_done, out_dir, None))
+        else:
+            q.start()
+            self.runWorkers(num_threads, self.bulkWorker, (q, ids_done, out_dir, bulk))
+
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        self.log.info('Workers finished')
@@ -1,12 +1,25 @@
-from os import path, mkdir, walk
-from requests.exceptions import HTTPError, ReadTimeout, ChunkedEncodingError
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from functools import partial
+from os import path, mkdir, scandir
+from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
+import asyncio
 import json
 import queue
+import re
 import threading
 import time
 
-from playstoreapi.googleplay import GooglePlayAPI, LoginError, RequestError
-from gplaycrawler.utils import get_logger
+from playstoreapi.googleplay import RequestError
+from gplaycrawler.analysis import Analysis
+from gplaycrawler.blobs import BlobStore
+from gplaycrawler.download import DownloadError, RangeDownloader
+from gplaycrawler.feed import AsyncFeedQueue, FeedQueue, read_ids, unique
+from gplaycrawler.manifest import Manifest
+from gplaycrawler.ratelimit import get_limiter
+from gplaycrawler.session import Backoff, SessionPool
+from gplaycrawler.store import ShardStore
+from gplaycrawler.utils import get_logger, strip_suffix
 
 
 class Packages:
@@ -15,7 +28,7 @@ class Packages:
         self.timezone = timezone
         self.device = device
         self.delay = delay
-        self.lastRequest = 0
+        self.limiter = get_limiter(delay)
 
         self.log_level = log_level
         self.log = get_logger(log_level, name=__name__)
@@ -26,179 +39,522 @@ class Packages:
         else:
             self.quiet = True
 
-    def worker(self, api, q, done_ids, out_dir, threads, expansion_files, splits):
-        while not q.empty():
-            if self.delay:
-                tosleep = -(time.time() - self.lastRequest - self.delay)
-                if tosleep > 0:
-                    # print('sleeping', tosleep)
-                    time.sleep(tosleep)
+        self.pool = SessionPool(locale, timezone, device, limiter=self.limiter, quiet=self.quiet, log=self.log)
+        self.downloader = RangeDownloader(log_level=log_level)
+        self.blobs = None
+        self.manifest = None
+        # expected sizes for the download lanes (and versions for mirror) come from the output of the metadata command
+        self.metadata = None
+        self.shards = None
+        self.large_size = None
+        # parallel requests of the files of one package
+        self.budget = 8
+        # mirror: current versionCodes of stored packages and how many old versions are kept
+        self.current = {}
+        self.keep = None
+        # optional stage that analyzes the finished packages
+        self.analysis = None
 
-            packageName = q.get_nowait()  # non blocking
-            self.log.debug(f'Start getting package "{packageName}"')
+    def save(self, download, packageName, out_dir, expansion_files, splits):
+        '''
+        write apk (and expansion files and splits) of a download to out_dir (or the blob store).
+        The files are fetched at the same time, all requests of the package together are limited to `budget`.
+        The package is recorded as done (manifest) only after every file is there with its size,
+        then it goes to the analysis stage
+        '''
+        if download['docId'] != packageName:
+            self.log.warning(f"package name doesn't match {download['docId']} != {packageName}")
+
+        files = []
+        if expansion_files is True and download['additionalData'] != []:
+            for obb in download['additionalData']:
+                files.append((f"{packageName}.{obb['type']}.{str(obb['versionCode'])}.obb", obb['file']))
+        if splits is True and download['splits'] != []:
+            for split in download.get('splits'):
+                files.append((f"{packageName}.split.{split['name']}.zip", split['file']))
+        files.append((packageName + '.apk', download['file']))
+
+        budget = threading.BoundedSemaphore(self.budget)
 
+        def fetch(name, file):
+            self.log.debug(f'Downloading {name}')
+            if self.blobs is None:
+                filepath = path.join(out_dir, name)
+                size, sha256 = self.downloader.fetch(file, filepath, budget)
+            else:
+                tmp = path.join(self.blobs.tmp, name)
+                size, sha256 = self.downloader.fetch(file, tmp, budget)
+                if not self.blobs.add(tmp, sha256):
+                    self.log.debug(f'{name}: already stored')
+                filepath = self.blobs.blob_path(sha256)
+            return filepath, size, sha256
+
+        manifest = {}
+        paths = {}
+        with ThreadPoolExecutor(max_workers=min(len(files), self.budget)) as executor:
+            futures = [(name, executor.submit(fetch, name, file)) for name, file in files]
             try:
-                # versionCode=None, offerType=1, expansion_files=False
-                download = api.download(packageName, expansion_files=expansion_files)
-                self.lastRequest = time.time()
-            except RequestError as e:
-                if "Can't install. Please try again later." in str(e):
-                    self.log.info(f'{packageName}: paid app. Skipping')
-                else:
-                    self.log.warning(f'{packageName}: {str(e)}')
-                    self.log.debug('Readd to queue')
-                    q.put_nowait(packageName)
-                q.task_done()
-                continue
-            except HTTPError as e:
-                if e.response.status_code == 429 or e.response.status_code == 401:
+                for name, future in futures:
+                    filepath, size, sha256 = future.result()
+                    if not path.isfile(filepath) or path.getsize(filepath) != size:
+                        raise DownloadError(f'{name}: missing after download')
+                    manifest[name] = {'sha256': sha256, 'size': size}
+                    paths[name] = filepath
+            except Exception:
+                # files that are not started yet are not needed, running ones finish into their .part files
+                for _, future in futures:
+                    future.cancel()
+                raise
+
+        if self.blobs is not None:
+            self.blobs.write_manifest(packageName, download.get('versionCode') or 0, manifest)
+            if self.keep is not None:
+                removed = self.blobs.prune(packageName, self.keep)
+                if removed:
+                    self.log.debug(f'{packageName}: removed old versions {", ".join(removed)}')
+        elif self.manifest is not None:
+            self.manifest.add(packageName, manifest, self.options(expansion_files, splits))
+
+        if self.analysis is not None:
+            # blocks while the backlog of the analysis is full
+            self.analysis.submit(packageName, download.get('versionCode'), paths)
+
+    @staticmethod
+    def options(expansion_files, splits):
+        '''
+        manifest options of a download with or without expansion files and splits
+        '''
+        return [option for option, on in (('expansions', expansion_files), ('splits', splits)) if on]
+
+    @staticmethod
+    def rebuild(out_dir):
+        '''
+        manifest entries of the packages of an older run (without hashes). A package is done when its apk
+        is there, the options are the kinds of extra files found for it
+        '''
+        apks = {}
+        extras = {}
+        splits = []
+        with scandir(out_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                info = {'size': entry.stat().st_size, 'sha256': None}
+                obb = re.fullmatch(r'(.+)\.\w+\.\d+\.obb', entry.name)
+                if '.split.' in entry.name and entry.name.endswith('.zip'):
+                    splits.append((entry.name, info))
+                elif obb is not None:
+                    extras.setdefault(obb.group(1), {})[entry.name] = ('expansions', info)
+                elif entry.name.endswith('.apk'):
+                    apks[strip_suffix(entry.name, '.apk')] = (entry.name, info)
+        for name, info in splits:
+            # package and split names can both contain '.split.', the package is the longest prefix with an apk
+            parts = strip_suffix(name, '.zip').split('.split.')
+            for n in range(len(parts) - 1, 0, -1):
+                packageName = '.split.'.join(parts[:n])
+                if packageName in apks:
+                    break
+            extras.setdefault(packageName, {})[name] = ('splits', info)
+        for packageName, (name, info) in apks.items():
+            files = {name: info}
+            options = set()
+            for extra, (option, extra_info) in extras.get(packageName, {}).items():
+                files[extra] = extra_info
+                options.add(option)
+            yield packageName, files, options
+
+    @staticmethod
+    def size(details, expansion_files):
+        '''
+        expected download size of an app from its details (installationSize, plus the expansion files) or None
+        '''
+        appDetails = (details or {}).get('details', {}).get('appDetails', {})
+        size = appDetails.get('installationSize')
+        if size is None:
+            return None
+        size = int(size)
+        if expansion_files:
+            size += sum(int(f.get('size') or 0) for f in appDetails.get('file', []) if f.get('fileType'))
+        return size
+
+    @staticmethod
+    def versionCode(details):
+        '''
+        versionCode of an app from its details (or a bulkDetails result) or None
+        '''
+        return (details or {}).get('details', {}).get('appDetails', {}).get('versionCode')
+
+    def stored(self, packageName):
+        '''
+        details of packageName in the output of the metadata command or None
+        '''
+        if self.shards is not None:
+            record = self.shards.get(packageName)
+            return None if record is None else record['details']
+        try:
+            with open(path.join(self.metadata, packageName + '.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def isLarge(self, packageName, expansion_files):
+        '''
+        whether the stored metadata of packageName says it is at least large_size bytes
+        '''
+        size = self.size(self.stored(packageName), expansion_files)
+        return size is not None and size >= self.large_size
+
+    def outdated(self, packageNames, bulk=100):
+        '''
+        mirror: the packages of packageNames (all in the blob store) whose current versionCode is not stored.
+        The versionCode comes from the metadata output if there is one, the others are looked up with
+        bulkDetails (`bulk` apps per request). A batch that fails as a whole is split in halves.
+        Packages without a known versionCode are left as they are
+        '''
+        lookup = []
+        for packageName in packageNames:
+            versionCode = None if self.metadata is None else self.versionCode(self.stored(packageName))
+            if versionCode is None:
+                lookup.append(packageName)
+            else:
+                self.current[packageName] = versionCode
+        self.log.info(f'Checking {len(lookup)} of {len(packageNames)} stored packages for new versions')
+
+        batches = deque()
+        for start in range(0, len(lookup), bulk):
+            stop = start + bulk
+            batches.append(lookup[start:stop])
+        todo = len(lookup)
+
+        api = self.pool.get()
+        backoff = Backoff()
+        while batches:
+            batch = batches.popleft()
+            try:
+                docs = api.bulkDetails(batch)
+                backoff.reset()
+            except (HTTPError, RequestError) as e:
+                if isinstance(e, HTTPError) and e.response.status_code in (401, 429):
                     if e.response.status_code == 401:
                         self.log.warning('Unauthorized. Trying relogin...')
                     else:
                         self.log.warning('packages got rate limited')
-                    api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-                    while True:
-                        try:
-                            api.envLogin(quiet=self.quiet, check=False)
-                        except LoginError:
-                            self.log.info('Login failed. Retry in 3 minutes')
-                            time.sleep(180)
-                        else:
-                            break
-                    self.log.debug('new api, logged in, try again')
+                        backoff.sleep()
+                    api = self.pool.relogin()
+                    batches.append(batch)
+                elif len(batch) == 1:
+                    self.log.warning(f'{batch[0]}: {str(e)}')
+                    todo -= 1
                 else:
-                    self.log.warning(str(e))
-                    q.task_done()
-                    continue
-            except ReadTimeout:
-                self.log.debug(f'Request did timeout (worker), add back {packageName}')
-                q.put_nowait(packageName)
-                q.task_done()
+                    self.log.debug(f'Batch of {len(batch)} failed ({str(e)}), splitting it')
+                    half = len(batch) // 2
+                    batches.append(batch[:half])
+                    batches.append(batch[half:])
+                continue
+            except (ReadTimeout, ConnectionError) as e:
+                self.log.debug(f'{type(e).__name__}, add back {len(batch)} packages')
+                if isinstance(e, ConnectionError):
+                    backoff.sleep()
+                batches.append(batch)
                 continue
+            for packageName, doc in zip(batch, docs):
+                versionCode = self.versionCode(doc)
+                if versionCode is not None:
+                    self.current[packageName] = versionCode
+            todo -= len(batch)
+            self.log.info(f'Known versions: {len(self.current)}, to check: {todo}')
 
-            # download = server.download(docid, expansion_files=True)
+        return {
+            packageName
+            for packageName in packageNames
+            if packageName in self.current and str(self.current[packageName]) not in self.blobs.versions(packageName)
+        }
 
-            if download['docId'] != packageName:
-                self.log.warning(f"package name doesn't match {download['docId']} != {packageName}")
+    def take(self, todo, large, lane, expansion_files):
+        '''
+        next (queue, packageName) for a worker of lane or None when there is nothing left.
+        The small lane hands packages of at least large_size on to the queue large, the large lane takes
+        those first and helps with the rest when there are none
+        '''
+        while True:
+            if lane == 'large':
+                try:
+                    return large, large.get_nowait()
+                except queue.Empty:
+                    pass
+            try:
+                packageName = todo.get(timeout=1)
+            except queue.Empty:
+                # the feeder (or for the large lane the small lane) can still add ids
+                if todo.unfinished_tasks == 0 and (lane != 'large' or large.unfinished_tasks == 0):
+                    return None
+                continue
+            try:
+                handover = lane == 'small' and self.isLarge(packageName, expansion_files)
+            except Exception as e:
+                self.log.warning(f'{packageName}: expected size unknown: {type(e).__name__}: {str(e)}')
+                handover = False
+            if handover:
+                large.put_nowait(packageName)
+                todo.task_done()
+                continue
+            return todo, packageName
 
-            filepath = path.join(out_dir, packageName + '.apk')
+    def worker(self, todo, done_ids, out_dir, threads, expansion_files, splits, large=None, lane=None):
+        api = self.pool.get()
+        backoff = Backoff()
+        while True:
+            item = self.take(todo, large, lane, expansion_files)
+            if item is None:
+                break
+            q, packageName = item
+            self.log.debug(f'Start getting package "{packageName}"')
 
-            self.log.debug('Downloading apk...')
+            # the item is finished, whatever happens, or the workers never stop
             try:
-                with open(filepath, 'wb') as f:
-                    for chunk in download.get('file').get('data'):
-                        f.write(chunk)
-            except ChunkedEncodingError as e:
-                self.warning(f'Error writing chunk for {packageName}.apk: {str(e)}')
-
-            if expansion_files is True and download['additionalData'] != []:
-                self.log.debug('Downloading additional files...')
-                for obb in download['additionalData']:
-                    name = f"{packageName}.{obb['type']}.{str(obb['versionCode'])}.obb"
-                    filepath = path.join(out_dir, name)
-                    self.log.debug(f'Additional file: {name}')
-                    try:
-                        with open(filepath, 'wb') as f:
-                            for chunk in obb.get('file').get('data'):
-                                f.write(chunk)
-                    except ChunkedEncodingError as e:
-                        self.warning(f'Error writing chunk for {name}: {str(e)}')
-
-            if splits is True and download['splits'] != []:
-                self.log.debug('Downloading splits...')
-                for split in download.get('splits'):
-                    name = f"{packageName}.split.{split['name']}.zip"
-                    filepath = path.join(out_dir, name)
-                    self.log.debug(f'Split: {name}')
-                    try:
-                        with open(filepath, "wb") as f:
-                            for chunk in split["file"]["data"]:
-                                f.write(chunk)
-                    except ChunkedEncodingError as e:
-                        self.warning(f'Error writing chunk for {name}: {str(e)}')
-
-            q.task_done()
-            self.log.info(f'Done: {len(done_ids)}, to do: {q.qsize()}')
-            done_ids.add(packageName)
+                try:
+                    # versionCode=None, offerType=1, expansion_files=False
+                    download = api.download(
+                        packageName, versionCode=self.current.get(packageName), expansion_files=expansion_files
+                    )
+                    backoff.reset()
+                except RequestError as e:
+                    if "Can't install. Please try again later." in str(e):
+                        self.log.info(f'{packageName}: paid app. Skipping')
+                    else:
+                        self.log.warning(f'{packageName}: {str(e)}')
+                        self.log.debug('Readd to queue')
+                        q.put_nowait(packageName)
+                    continue
+                except HTTPError as e:
+                    if e.response.status_code == 429 or e.response.status_code == 401:
+                        if e.response.status_code == 401:
+                            self.log.warning('Unauthorized. Trying relogin...')
+                        else:
+                            self.log.warning('packages got rate limited')
+                            backoff.sleep()
+                        api = self.pool.relogin()
+                        self.log.debug(f'new api, logged in, add back {packageName}')
+                        q.put_nowait(packageName)
+                    else:
+                        self.log.warning(str(e))
+                    continue
+                except (ReadTimeout, ConnectionError) as e:
+                    self.log.debug(f'{type(e).__name__} (worker), add back {packageName}')
+                    if isinstance(e, ConnectionError):
+                        backoff.sleep()
+                    q.put_nowait(packageName)
+                    continue
+
+                # download = server.download(docid, expansion_files=True)
+
+                # finished parts stay in the .part files for the next run
+                self.save(download, packageName, out_dir, expansion_files, splits)
+                self.log.info(f'Done: {len(done_ids)}, to do: {q.qsize()}')
+                done_ids.add(packageName)
+            except Exception as e:
+                # DownloadError, or an error while writing the files
+                self.log.warning(f'{packageName}: {type(e).__name__}: {str(e)}')
+            finally:
+                q.task_done()
 
         t = threading.current_thread()
         self.log.info(f'{t.name} finished. Queue empty')
         t.done = True
         return
 
-    def getPackages(self, in_file, out_dir, num_threads, expansion_files, splits):
-        ids = set()
+    async def asyncPackages(self, engine, q, done_ids, out_dir, expansion_files, splits, large_threads=None):
+        '''
+        same as worker but running on the event loop of engine, the ids of the FeedQueue q are read from there.
+        With large_threads the large lane has its own queue that is drained by that many tasks
+        '''
+        aq = AsyncFeedQueue(q.items, q.limit)
+        feeder = asyncio.ensure_future(aq.feed(engine))
+        large = None
+        if large_threads is not None:
+            large = asyncio.Queue()
+            large.feeding = True
+
+        async def handler(packageName):
+            if large is not None and await engine.offload(self.isLarge, packageName, expansion_files):
+                large.put_nowait(packageName)
+                return
+            await fetch(aq, packageName)
+
+        async def fetch(aq, packageName):
+            self.log.debug(f'Start getting package "{packageName}"')
+            try:
+                download = await engine.request(
+                    'download', packageName, versionCode=self.current.get(packageName), expansion_files=expansion_files
+                )
+            except RequestError as e:
+                if "Can't install. Please try again later." in str(e):
+                    self.log.info(f'{packageName}: paid app. Skipping')
+                else:
+                    self.log.warning(f'{packageName}: {str(e)}')
+                    self.log.debug('Readd to queue')
+                    aq.put_nowait(packageName)
+                return
+
+            try:
+                await engine.call(self.save, download, packageName, out_dir, expansion_files, splits)
+            except DownloadError as e:
+                self.log.warning(f'{packageName}: {str(e)}')
+                return
+
+            self.log.info(f'Done: {len(done_ids)}, to do: {aq.qsize()}')
+            done_ids.add(packageName)
+
+        async def small():
+            await engine.drain(aq, handler)
+            if large is not None:
+                large.feeding = False
+
+        if large is None:
+            await small()
+        else:
+            await asyncio.gather(small(), engine.drain(large, partial(fetch, large), tasks=large_threads))
+        await feeder
 
+    def getPackages(
+        self,
+        in_file,
+        out_dir,
+        num_threads,
+        expansion_files,
+        splits,
+        engine=None,
+        parts=4,
+        storage='files',
+        metadata=None,
+        large_size=100 * 1024 * 1024,
+        large_threads=1,
+        bandwidth=None,
+        budget=8,
+        mirror=False,
+        keep=1,
+        analyzers=None,
+        processes=None,
+        backlog=100,
+    ):
+        '''
+        download the packages of the ids in in_file to out_dir.
+        With metadata (an output directory of the metadata command) apps that are expected to be at least
+        large_size bytes go to a lane of large_threads workers of their own, so they don't hold up the others.
+        bandwidth limits all downloads together to that many bytes per second.
+        The apk, expansion files and splits of a package are fetched at the same time with at most budget
+        requests together (parts of the files included).
+        mirror keeps a blob store up to date: stored packages are downloaded again when their current
+        versionCode (from metadata or bulkDetails) is not stored, keep old versions per package are kept and
+        blobs no version needs anymore are deleted at the end.
+        With analyzers every finished package is analyzed on a pool of processes (see Analysis), at most
+        backlog packages wait for it
+        '''
+        self.downloader.parts = parts
+        self.budget = max(budget, 1)
+        self.downloader.set_bandwidth(bandwidth)
+        self.large_size = large_size
+        self.metadata = self.shards = None
+        if metadata is not None:
+            self.metadata = metadata
+            if path.exists(path.join(metadata, 'index.tsv')):
+                self.shards = ShardStore(metadata)
+        # separate lane for large apps
+        split = self.metadata is not None and large_threads > 0
+        self.current = {}
+        self.keep = None
+        if mirror:
+            # versions are only kept apart in the blob store
+            storage = 'blobs'
+            self.keep = max(keep, 0)
+
+        # the input is read while the workers run
         try:
-            with open(in_file) as f:
-                j = json.load(f)
+            ids = read_ids(in_file)
         except FileNotFoundError:
             self.log.error('Input file not found')
             return
 
-        if type(j) == list:
-            ids.update(j)
+        if storage == 'blobs':
+            self.blobs = BlobStore(out_dir)
+            ids_done = self.blobs.packages()
+            if mirror:
+                stored = [packageName for packageName in unique(read_ids(in_file)) if packageName in ids_done]
+                outdated = self.outdated(stored)
+                self.log.info(f'{len(outdated)} of {len(stored)} stored packages have a new version')
+                ids_done = ids_done - outdated
         else:
-            try:
-                ids.update(j['done'])
-                ids.update(j['ids'])
-            except KeyError:
-                self.log.error('Input file is in unknown format')
+            # finished packages are in the manifest, the directory is only listed if there is none yet.
+            # Packages downloaded without the requested expansion files or splits are not done
+            self.manifest = Manifest(out_dir, rebuild=lambda: self.rebuild(out_dir))
+            ids_done = self.manifest.packages(self.options(expansion_files, splits))
 
-        # load ids that are already done via amp
-        try:
-            (_, _, done_filenames) = next(walk(out_dir))
-        except StopIteration:
-            done_filenames = []
-
-        ids_done = set()
-        for file in set(done_filenames):
-            ids_done.add(file.rstrip('.apk'))
+        if analyzers:
+            try:
+                self.analysis = Analysis(out_dir, analyzers, processes, backlog, log_level=self.log_level)
+            except (ValueError, ImportError, AttributeError) as e:
+                self.log.error(str(e))
+                return
 
-        todo_ids = ids - ids_done
-        q = queue.Queue()
-        for packageName in todo_ids:
-            q.put_nowait(packageName)
+        q = FeedQueue(unique(ids, ids_done))
 
-        self.log.info(f'Done: {len(ids_done)}, to do: {q.qsize()}')
+        self.log.info(f'Done: {len(ids_done)}, reading the ids to do from {in_file}')
         try:
             mkdir(out_dir)
         except FileExistsError:
             pass
 
-        i = 0
-        threads = []
-        while num_threads > 0:
-            while len(threads) < num_threads:
-                api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-                while True:
-                    try:
-                        api.envLogin(quiet=self.quiet, check=False)
-                    except LoginError:
-                        self.log.info('Login failed. Retry in 3 minutes')
-                        time.sleep(180)
-                    else:
-                        break
-                t = threading.Thread(
-                    target=self.worker, args=(api, q, ids_done, out_dir, threads, expansion_files, splits)
-                )
-                i += 1
-                t.name = f'Worker-{i}'
-                t.done = False
-                threads.append(t)
-                t.start()
-                self.log.info(f'Started {t.name}')
-                # wait 10-11 min to start next thread
-                # time.sleep(60 * 10 + random() * 60)
-
-            for t in threads:
-                t.join(timeout=1)
-                if not t.is_alive():
-                    if t.done:
-                        num_threads -= 1
-                    else:
+        if engine is not None:
+            lanes = large_threads if split else None
+            engine.run(self.pool, self.asyncPackages, engine, q, ids_done, out_dir, expansion_files, splits, lanes)
+        else:
+            q.start()
+            # number of workers per lane, without expected sizes there is only one lane
+            if not split:
+                large = None
+                lanes = {None: num_threads}
+            else:
+                large = queue.Queue()
+                lanes = {'small': num_threads, 'large': large_threads}
+            i = 0
+            threads = []
+            while sum(lanes.values()) > 0:
+                for lane, n in lanes.items():
+                    while sum(t.lane == lane for t in threads) < n:
+                        t = threading.Thread(
+                            target=self.worker,
+                            args=(q, ids_done, out_dir, threads, expansion_files, splits, large, lane),
+                        )
+                        i += 1
+                        t.name = f'Worker-{i}'
+                        t.done = False
+                        t.lane = lane
+                        threads.append(t)
+                        t.start()
+                        self.log.info(f'Started {t.name}' + (f' ({lane} lane)' if lane else ''))
+                        # wait 10-11 min to start next thread
+                        # time.sleep(60 * 10 + random() * 60)
+
+                for t in list(threads):
+                    t.join(timeout=1)
+                    if not t.is_alive():
                         threads.remove(t)
-                        self.log.info(f'Worker {t.name} crashed. Starting a new worker')
-                        time.sleep(1)
+                        if t.done:
+                            lanes[t.lane] -= 1
+                        else:
+                            self.log.info(f'Worker {t.name} crashed. Starting a new worker')
+                            time.sleep(1)
 
-        self.log.info('Threads finished')
+        if mirror:
+            count, size = self.blobs.gc()
+            self.log.info(f'Deleted {count} unused blobs ({size / 1024 / 1024:.1f} MB)')
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        if self.analysis is not None:
+            self.analysis.close()
+            self.analysis = None
+        self.log.info('Workers finished')
@@ -0,0 +1,131 @@
+# stdlib
+from collections import deque
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    Thread safe token bucket. `rate` tokens are added per second up to `capacity`.
+    A rate of None means unlimited
+    '''
+
+    def __init__(self, rate=None, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, tokens=1):
+        '''
+        block until `tokens` tokens are available and take them
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.rate is None:
+                    return
+                # allow requests bigger than the bucket, they just have to wait for a full bucket
+                needed = min(tokens, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return
+                tosleep = (needed - self.tokens) / self.rate
+            time.sleep(tosleep)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+
+class RateLimiter(TokenBucket):
+    '''
+    Token bucket for requests that adapts its rate to the server:
+    on a 429 the rate is multiplied by `decrease`, after `increase_after` successful requests in a row it is
+    multiplied by `increase`. Close to the rate of the last 429 it only creeps up, so the limiter settles just
+    below the limit of the server instead of bouncing off it
+    '''
+
+    def __init__(self, rate=None, min_rate=0.05, decrease=0.5, increase=1.05, increase_after=20, cooldown=2):
+        super().__init__(rate, capacity=1)
+        self.min_rate = min_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.increase_after = increase_after
+        self.cooldown = cooldown
+        self.ceiling = None
+        self.successes = 0
+        self.last_throttle = 0
+        self.history = deque(maxlen=100)
+
+    def acquire(self, tokens=1):
+        super().acquire(tokens)
+        self.history.append(time.monotonic())
+
+    def observed_rate(self):
+        '''
+        requests per second of the last requests
+        '''
+        history = list(self.history)
+        if len(history) < 2 or history[-1] == history[0]:
+            return None
+        return (len(history) - 1) / (history[-1] - history[0])
+
+    def throttled(self):
+        '''
+        the server answered with 429
+        '''
+        now = time.monotonic()
+        with self.lock:
+            self.successes = 0
+            # all requests in flight see the same 429, only back off once for them
+            if now - self.last_throttle < self.cooldown:
+                return
+            self.last_throttle = now
+        rate = self.rate
+        if rate is None:
+            rate = self.observed_rate() or 1
+        self.ceiling = rate
+        self.set_rate(max(self.min_rate, rate * self.decrease))
+
+    def succeeded(self):
+        '''
+        a request went through
+        '''
+        with self.lock:
+            if self.rate is None:
+                return
+            self.successes += 1
+            if self.successes < self.increase_after:
+                return
+            self.successes = 0
+        rate = self.rate * self.increase
+        if self.ceiling is not None and rate > self.ceiling * 0.9:
+            # probe slowly near the last known limit and forget it over time
+            rate = min(rate, max(self.rate, self.ceiling * 0.9) * 1.01)
+            self.ceiling *= 1.002
+        self.set_rate(rate)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter(delay=None):
+    '''
+    Rate limiter shared by all commands and workers of this process.
+    The first call sets the initial rate to one request per `delay` seconds
+    '''
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter(rate=1 / delay if delay else None)
+        return _limiter
@@ -1,13 +1,22 @@
+from collections import Counter
+from itertools import islice
+from os import path
+import asyncio
 import json
 import threading
 import time
 import queue
-from requests.exceptions import HTTPError, ReadTimeout
-import random
-
-from playstoreapi.googleplay import GooglePlayAPI, LoginError
-from gplaycrawler.utils import get_logger
-
+from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
+
+from gplaycrawler.cache import StreamCache
+from gplaycrawler.feed import read_ids
+from gplaycrawler.frontier import Frontier
+from gplaycrawler.graph import Graph
+from gplaycrawler.ids import BloomFilter, CountMinSketch, IdMap, IdRegistry, IdSet
+from gplaycrawler.ratelimit import get_limiter
+from gplaycrawler.schedule import AsyncPopularityQueue, PopularityQueue, PopularityScheduler
+from gplaycrawler.session import Backoff, SessionPool
+from gplaycrawler.utils import get_logger, strip_suffix
 
 # def details(packageName):
 
@@ -28,6 +37,7 @@ class Related:
         self.timezone = timezone
         self.device = device
         self.delay = delay
+        self.limiter = get_limiter(delay)
 
         self.log_level = log_level
         self.log = get_logger(log_level, name=__name__)
@@ -38,34 +48,44 @@ class Related:
         else:
             self.quiet = True
 
+        self.pool = SessionPool(
+            locale, timezone, device, limiter=self.limiter, quiet=self.quiet, check=True, log=self.log
+        )
+
+        # crawl state: lowest known depth of every id (None with Bloom filters), queued ids per level,
+        # first unfinished level
+        self.lock = threading.Lock()
+        self.depths = None
+        self.levels = Counter()
+        self.level = 0
+        self.snapshots = []
+        self.cache = StreamCache()
+        self.graph = None
+
     def streamPages(self, api, nextPageUrl):
         ids = set()
+        backoff = Backoff()
         while True:
             try:
                 d = api.streamDetails(nextPageUrl=nextPageUrl)
+                backoff.reset()
             except HTTPError as e:
                 if e.response.status_code == 429 or e.response.status_code == 401:
                     if e.response.status_code == 401:
                         self.log.warning('Unauthorized. Trying relogin...')
                     else:
                         self.log.debug('streamPages got rate limited')
-                    api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-                    while True:
-                        try:
-                            api.envLogin(quiet=self.quiet)
-                        except LoginError:
-                            self.log.info('Login failed. Retry in 3 minutes')
-                            time.sleep(180)
-                        else:
-                            break
+                        backoff.sleep()
+                    api = self.pool.relogin()
                     self.log.debug('new api, logged in, try again')
                 else:
                     self.log.warning(str(e))
                 continue
 
             except ReadTimeout:
-                self.log.debug('Request did timeout (pages), try again in 1 min')
-                time.sleep(60)
+                delay = backoff.delay()
+                self.log.debug(f'Request did timeout (pages), try again in {delay:.1f} seconds')
+                time.sleep(delay)
                 continue
             try:
                 streamBundle = d['item'][0]['subItem']
@@ -88,7 +108,10 @@ class Related:
                 ids.add(subItem['id'])
             # print(stream['title'], len(ids))
 
-    def streamDetails(self, api, ids, packageName):
+    def streamDetails(self, api, ids, packageName, streams=None):
+        '''
+        add the ids of all streams of packageName to ids and, if given, to streams by stream title
+        '''
         d = api.streamDetails(packageName)
         try:
             streamBundle = d['item'][0]['subItem']
@@ -101,8 +124,9 @@ class Related:
                 return
         for stream in streamBundle:
             # print(packageName, stream['title'])
+            stream_ids = set()
             for subItem in stream['subItem']:
-                ids.add(subItem['id'])
+                stream_ids.add(subItem['id'])
 
             # get all pages for every stream
             try:
@@ -110,195 +134,362 @@ class Related:
             except KeyError:
                 pass
             else:
-                i = self.streamPages(api, nextPageUrl)
-                before = len(ids)
-                ids.update(i)
-                new = len(ids) - before
-                self.log.debug(f"{packageName} {stream['title']}: Got {len(i)} package names, {new} new")
+                # streams are shared between apps, so their further pages are cached
+                keys = [nextPageUrl, self.cache.identity(stream)]
+                i = self.cache.get(*keys)
+                if i is None:
+                    i = self.streamPages(api, nextPageUrl)
+                    self.cache.put(keys, i)
+                stream_ids.update(i)
+                self.log.debug(f"{packageName} {stream['title']}: Got {len(i)} package names")
+
+            ids.update(stream_ids)
+            if streams is not None:
+                streams.setdefault(stream.get('title'), set()).update(stream_ids)
 
             # print('return', len(ids), ids)
             # return ids
 
-    def worker(self, api, q, ids, done_ids, shared, tmp_file, out_file, until_level=3):
-        s = shared
-        t = threading.current_thread()
-        t.level = s['level']
-        t.idle = False
-        while True:
-            try:
-                packageName = q.get_nowait()  # non blocking
-                self.log.debug(f'Start crawling {packageName}')
-            except queue.Empty:
-                t.idle = True
-                time.sleep(random.random())
-                if t.level != s['level']:
-                    if s['level'] > until_level:
-                        self.log.info('Done')
-                        t.done = True
-                        return
-                    else:
-                        self.log.debug('sleeping (wait for save and filled queue')
-                        while q.empty():
-                            time.sleep(1)
-                        t.idle = False
-                        t.level += 1
-                        continue
+    def saveResult(self, packageName, found, ids, done_ids, frontier, depth):
+        '''
+        add the ids found for packageName and record it in the frontier
+        '''
+        new_ids = found - ids
+        ids.update(new_ids)
+        done_ids.add(packageName)
+
+        frontier.add_ids(found, depth=depth)
+        frontier.mark_done(packageName, found=len(found), new=len(new_ids))
+        frontier.checkpoint()
 
-                # this code is just run by the first thread
-                # level up and save
-                t.level += 1
-                s['level'] += 1
-                for thread in s['threads']:
-                    while not thread.idle:
-                        self.log.debug('Waiting for other threads to finish level')
-                        time.sleep(1)
-
-                todo_ids = ids - done_ids
-                self.log.info(f'Done with level {s["level"]}. Got {len(ids)} IDs. Done IDs: {len(done_ids)}')
-
-                self.log.info('Saving json file\n')
-                if s['level'] > until_level:
-                    filename = f'{out_file}.json'
+    def addResult(self, q, depth, packageName, found, ids, done_ids, frontier, out_file, until_level):
+        '''
+        save the ids found for packageName (None if it was done already) and queue the ones that are not known
+        at a lower depth yet, up to until_level. When all ids of a level are done a snapshot is written
+        '''
+        with self.lock:
+            if found is not None:
+                if self.depths is None:
+                    # Bloom filters: an id keeps the depth it was found at first
+                    todo = found - ids
                 else:
-                    filename = f'{out_file}_level-{s["level"]}.json'
+                    todo = [i for i in found if i not in done_ids and self.depths.get(i, depth + 2) > depth + 1]
+                    for i in todo:
+                        self.depths[i] = depth + 1
+                self.saveResult(packageName, found, ids, done_ids, frontier, depth + 1)
+                if isinstance(q, (PopularityQueue, AsyncPopularityQueue)):
+                    q.reference(found)
+                if depth + 1 <= until_level:
+                    for i in todo:
+                        if i not in done_ids:
+                            self.levels[depth + 1] += 1
+                            q.put_nowait((depth + 1, i))
+                self.log.info(f'Done: {len(done_ids)}, to do: {q.qsize()} received {len(ids)} ids (level {depth})')
+
+            # items only add items of the next level, so a level is complete when it and all before are done
+            self.levels[depth] -= 1
+            while self.level <= until_level and self.levels[self.level] == 0:
+                self.level += 1
+                self.log.info(f'Done with level {self.level}. Got {len(ids)} IDs. Done IDs: {len(done_ids)}')
+                if self.level <= until_level:
+                    self.snapshot(f'{out_file}_level-{self.level}.json', done_ids, ids)
+
+    def seed(self, packageName, done_ids):
+        '''
+        count the input id packageName for level 0, False if it is done or at depth 0 already
+        '''
+        with self.lock:
+            if packageName in done_ids:
+                return False
+            if self.depths is not None:
+                if self.depths.get(packageName) == 0:
+                    return False
+                self.depths[packageName] = 0
+            self.levels[0] += 1
+            return True
+
+    def feed(self, q, in_ids, ids, done_ids, frontier, out_file, until_level, limit=10000):
+        '''
+        queue the input ids at depth 0 while the workers run, at most limit of them at the same time.
+        Until all are read, the feeder holds a count of level 0 and an unfinished task of q (see FeedQueue)
+        limit has to be well above the number of workers, so they don't run out of input ids and take deeper
+        items first (with Bloom filters an input id that is found before it is fed keeps the deeper depth)
+        '''
+        try:
+            for packageName in in_ids:
+                if not self.seed(packageName, done_ids):
+                    continue
+                while self.levels[0] > limit:
+                    with q.not_full:
+                        q.not_full.wait(timeout=1)
+                q.put_nowait((0, packageName))
+        finally:
+            self.addResult(q, 0, None, None, ids, done_ids, frontier, out_file, until_level)
+            q.task_done()
 
-                with open(filename, 'w') as f:
-                    json.dump({"done": list(done_ids), "ids": list(ids)}, f, indent=2)
+    def snapshot(self, filename, done_ids, ids):
+        '''
+        write the current state to filename in a background thread
+        '''
+        if self.depths is None:
+            # Bloom filters can't be listed, the frontier has all ids
+            self.frontier.checkpoint(force=True)
+            state = None
+        else:
+            # this runs under the crawl lock: only copy the bitmaps, the names are listed by the writer
+            state = (done_ids.copy(), ids.copy())
 
-                if s['level'] > until_level:
-                    self.log.info(f'{t.name}: First thread done')
-                    t.done = True
-                    return
+        def write():
+            self.log.info(f'Saving json file {filename}')
+            if state is None:
+                self.frontier.export_json(filename)
+                return
+            with open(filename, 'w') as f:
+                json.dump({"done": list(state[0]), "ids": list(state[1])}, f, indent=2)
 
-                for packageName in todo_ids:
-                    q.put_nowait(packageName)
+        t = threading.Thread(target=write, name='Snapshot')
+        t.start()
+        self.snapshots.append(t)
 
-                self.log.info(f'Filled queue for next level: {s["level"]}, Todo: {q.qsize()}\n')
+    def worker(self, q, ids, done_ids, frontier, out_file, until_level=3):
+        api = self.pool.get()
+        backoff = Backoff()
+        while True:
+            try:
+                depth, packageName = q.get(timeout=1)
+            except queue.Empty:
+                # other workers can still add ids
+                if q.unfinished_tasks == 0:
+                    break
                 continue
+            # the item is finished, whatever happens, or the workers never stop
             try:
-                self.streamDetails(api, ids, packageName)
-            except HTTPError as e:
-                if e.response.status_code == 429 or e.response.status_code == 401:
-                    if e.response.status_code == 401:
-                        self.log.warning('Unauthorized. Trying relogin...')
-                    else:
-                        self.log.debug('streamDetails got rate limited')
-                    api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-                    while True:
-                        try:
-                            api.envLogin(quiet=self.quiet)
-                        except LoginError:
-                            self.log.info('Login failed. Retry in 3 minutes')
-                            time.sleep(180)
+                with self.lock:
+                    done = packageName in done_ids
+                if done:
+                    # it was queued again at a lower depth
+                    self.addResult(q, depth, packageName, None, ids, done_ids, frontier, out_file, until_level)
+                    continue
+                self.log.debug(f'Start crawling {packageName}')
+
+                found = set()
+                streams = {}
+                try:
+                    self.streamDetails(api, found, packageName, streams)
+                    backoff.reset()
+                except HTTPError as e:
+                    if e.response.status_code == 429 or e.response.status_code == 401:
+                        if e.response.status_code == 401:
+                            self.log.warning('Unauthorized. Trying relogin...')
                         else:
-                            break
-                    self.log.debug(f'new api, logged in, add back {packageName}')
-                    q.put_nowait(packageName)
-                    q.task_done()
+                            self.log.debug('streamDetails got rate limited')
+                            backoff.sleep()
+                        api = self.pool.relogin()
+                        self.log.debug(f'new api, logged in, add back {packageName}')
+                        q.put_nowait((depth, packageName))
+                        continue
+                    else:
+                        self.log.warning(str(e))
+                except (ReadTimeout, ConnectionError) as e:
+                    self.log.debug(f'{type(e).__name__} (details), add back {packageName}')
+                    if isinstance(e, ConnectionError):
+                        backoff.sleep()
+                    q.put_nowait((depth, packageName))
                     continue
-                else:
-                    self.log.warning(str(e))
-            except ReadTimeout:
-                self.log.debug(f'Request did timeout (details), add back {packageName}')
-                q.put_nowait(packageName)
+                except Exception as e:
+                    # a RequestError or a malformed response: the app is not done, but its level can go on
+                    self.log.warning(f'{packageName}: {type(e).__name__}: {str(e)}')
+                    found = None
+
+                if self.graph is not None and found is not None:
+                    self.graph.add(packageName, streams)
+                self.addResult(q, depth, packageName, found, ids, done_ids, frontier, out_file, until_level)
+            except Exception as e:
+                self.log.warning(f'{packageName}: {type(e).__name__}: {str(e)}')
+            finally:
                 q.task_done()
-                continue
-
-            q.task_done()
-            self.log.info(f'Done: {len(done_ids)}, to do: {q.qsize()} received {len(ids)} ids (level {t.level})')
-            done_ids.add(packageName)
 
-            # save tmp file regularly
-            num_threads = len(s['threads'])
-            if len(done_ids) % (100 * num_threads) == 0:
-                self.log.debug(f'Saving tmp file {tmp_file}')
-                with open(tmp_file, 'w') as f:
-                    json.dump({"done": list(done_ids), "ids": list(ids)}, f, indent=2)
+        t = threading.current_thread()
+        self.log.info(f'{t.name} finished. Queue empty')
+        t.done = True
 
-    def getRelated(self, in_file, out_file, until_level=3, threads=3):
+    async def asyncRelated(self, engine, q, in_ids, ids, done_ids, frontier, out_file, until_level=3, limit=10000):
         '''
-        parallel downloading of related apps from charts.json and saving them in a json file
+        same as worker but running on the event loop of engine, the input ids are read from there (see feed)
         '''
-        with open(in_file) as f:
-            input_dict = json.load(f)
-
-        in_ids = set()
-        try:
-            for cat in input_dict:
-                for chart in input_dict[cat]:
-                    in_ids.update(input_dict[cat][chart])
-        except TypeError:
-            self.log.info('doesn\'t look like a charts.json. Trying to load level file')
-            if type(input_dict) == list:
-                in_ids.update(input_dict)
-            elif type(input_dict.get('ids')) == list:
-                in_ids.update(input_dict['ids'])
-            else:
-                self.log.error('Could not load input file')
-                return
+        if isinstance(q, PopularityQueue):
+            aq = AsyncPopularityQueue(q.scheduler.copy())
+        else:
+            aq = asyncio.PriorityQueue()
+        while not q.empty():
+            aq.put_nowait(q.get_nowait())
+        aq.feeding = True
 
-        out_file = out_file.rstrip('.json')
+        async def feed(chunk_size=1000):
+            try:
+                while True:
+                    names = await engine.offload(list, islice(in_ids, chunk_size))
+                    if not names:
+                        return
+                    for packageName in names:
+                        if self.seed(packageName, done_ids):
+                            aq.put_nowait((0, packageName))
+                    while self.levels[0] > limit:
+                        await asyncio.sleep(0.1)
+            finally:
+                aq.feeding = False
+                self.addResult(aq, 0, None, None, ids, done_ids, frontier, out_file, until_level)
+
+        feeder = asyncio.ensure_future(feed())
+
+        async def handler(item):
+            depth, packageName = item
+            found = None
+            if packageName not in done_ids:
+                self.log.debug(f'Start crawling {packageName}')
+                found = set()
+                streams = {}
+                try:
+                    await engine.request(self.streamDetails, found, packageName, streams)
+                except (ReadTimeout, ConnectionError):
+                    # added back by drain
+                    raise
+                except HTTPError as e:
+                    if e.response.status_code == 429 or e.response.status_code == 401:
+                        raise
+                    self.log.warning(str(e))
+                except Exception as e:
+                    self.log.warning(f'{packageName}: {type(e).__name__}: {str(e)}')
+                    found = None
+                if self.graph is not None and found is not None:
+                    self.graph.add(packageName, streams)
+            self.addResult(aq, depth, packageName, found, ids, done_ids, frontier, out_file, until_level)
+
+        await engine.drain(aq, handler)
+        await feeder
+
+    def getRelated(
+        self,
+        in_file,
+        out_file,
+        until_level=3,
+        threads=3,
+        engine=None,
+        cache_size=10000,
+        cache_file=None,
+        graph=None,
+        order='depth',
+        queue_size=100000,
+        bloom=None,
+    ):
+        '''
+        parallel downloading of related apps from charts.json and saving them in a json file.
+        Further pages of up to cache_size streams are kept in memory, with cache_file in a database as well.
+        With graph the edges (app, stream title, related app) are written to that directory.
+        Levels are crawled one after another, with the order 'popularity' the apps most other apps link to
+        come first within a level and at most queue_size of them are kept in memory.
+        Known ids are interned in an IdRegistry, with bloom they are only kept in Bloom filters sized for
+        that many ids and the output is read back from the frontier
+        '''
+        # charts.json, the ids of a level file or a list of ids, read without loading all of it
+        in_ids = read_ids(in_file, skip=('done',))
 
-        ids = set()
-        done_ids = set()
+        out_file = strip_suffix(out_file, '.json')
+        self.cache = StreamCache(size=cache_size, filename=cache_file)
+        if graph is not None:
+            self.graph = Graph(graph)
 
-        # resume from tmp file if it exists
+        # resume from the frontier, a tmp file of older versions is imported once
+        frontier = self.frontier = Frontier(out_file + '_frontier.db')
         tmp_file = out_file + '_tmp.json'
-        try:
-            with open(tmp_file) as f:
-                done = json.load(f)
-            done_ids.update(done['done'])
-            ids.update(done['ids'])
-        except FileNotFoundError:
-            pass
-        except Exception as e:
-            self.log.warning(str(e))
-
-        todo_ids = in_ids - done_ids
-        q = queue.Queue()
-        for packageName in todo_ids:
-            q.put_nowait(packageName)
-
-        self.log.info(f'Done: {len(done_ids)}, to do: {q.qsize()} received {len(ids)} ids')
-
-        # needs to be dict
-        shared = dict()
-        shared['level'] = 0
-        shared['threads'] = []
-
-        i = 0
-        while True:
-            while len(shared['threads']) < threads:
-                api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-                while True:
-                    try:
-                        api.envLogin(quiet=self.quiet)
-                    except LoginError:
-                        self.log.info('Login failed. Retry in 3 minutes')
-                        time.sleep(180)
-                    else:
-                        break
-
-                t = threading.Thread(
-                    target=self.worker, args=(api, q, ids, done_ids, shared, tmp_file, out_file, until_level)
-                )
-                i += 1
-                t.name = f'Worker-{i}'
-                t.done = False
-                shared['threads'].append(t)
-                t.start()
-                self.log.info(f'Started {t.name}')
-
-            for t in shared['threads']:
-                t.join(timeout=1)
-                if not t.is_alive():
-                    if t.done:
-                        threads -= 1
-                    else:
-                        self.log.info(f'Worker {t.name} crashed. Starting a new worker')
-                        time.sleep(1)
+        if frontier.is_empty() and path.exists(tmp_file):
+            self.log.info(f'Importing {tmp_file}')
+            frontier.import_json(tmp_file)
+
+        # every id carries the depth it was found at (the input has depth 0), the queue hands out lower depths
+        # first. The ids of the frontier are queued right away, the input is fed while the workers run
+        if bloom is None:
+            registry = IdRegistry()
+            self.depths = IdMap(registry, frontier.iter_ids())
+            ids = IdSet(registry, (packageName for packageName, _ in self.depths.items()))
+            done_ids = IdSet(registry, frontier.iter_done())
+            todo = self.depths.items()
+        else:
+            self.depths = None
+            registry = None
+            ids = BloomFilter(bloom)
+            ids.update(packageName for packageName, _ in frontier.iter_ids())
+            done_ids = BloomFilter(bloom)
+            done_ids.update(frontier.iter_done())
+            todo = frontier.iter_ids()
+        self.levels = Counter()
+        self.level = 0
+        self.snapshots = []
+
+        if order == 'popularity':
+            # in-degrees are counted over the interned ids of the crawl, with Bloom filters in a sketch of the
+            # same size (2 bytes per id)
+            indegree = None if bloom is None else CountMinSketch(bloom // 2)
+            q = PopularityQueue(PopularityScheduler(max_items=queue_size, indegree=indegree, registry=registry))
+        else:
+            q = queue.PriorityQueue()
+        for packageName, depth in todo:
+            if packageName not in done_ids and depth <= until_level:
+                self.levels[depth] += 1
+                q.put_nowait((depth, packageName))
+
+        self.log.info(f'Done: {len(done_ids)}, to do: {q.qsize()} received {len(ids)} ids, reading {in_file}')
+
+        # level 0 is not done before the feeder has read all input ids
+        self.levels[0] += 1
+        if engine is not None:
+            engine.run(self.pool, self.asyncRelated, engine, q, in_ids, ids, done_ids, frontier, out_file, until_level)
+        else:
+            with q.mutex:
+                q.unfinished_tasks += 1
+            feeder = threading.Thread(
+                target=self.feed, args=(q, in_ids, ids, done_ids, frontier, out_file, until_level), daemon=True
+            )
+            feeder.name = 'Feeder'
+            feeder.start()
+            i = 0
+            workers = []
+            while threads > 0:
+                while len(workers) < threads:
+                    t = threading.Thread(target=self.worker, args=(q, ids, done_ids, frontier, out_file, until_level))
+                    i += 1
+                    t.name = f'Worker-{i}'
+                    t.done = False
+                    workers.append(t)
+                    t.start()
+                    self.log.info(f'Started {t.name}')
+
+                for t in list(workers):
+                    t.join(timeout=1)
+                    if not t.is_alive():
+                        workers.remove(t)
+                        if t.done:
+                            threads -= 1
+                        else:
+                            self.log.info(f'Worker {t.name} crashed. Starting a new worker')
+                            time.sleep(1)
 
-        self.log.info('Threads finished')
+        self.log.info('Workers finished')
+        for t in self.snapshots:
+            t.join()
         self.log.info(f'Saving out file {out_file}.json')
-        with open(out_file + '.json', 'w') as f:
-            json.dump({"done": list(done_ids), "ids": list(ids)}, f, indent=2)
+        if self.depths is None:
+            frontier.checkpoint(force=True)
+            frontier.export_json(out_file + '.json')
+        else:
+            with open(out_file + '.json', 'w') as f:
+                json.dump({"done": list(done_ids), "ids": list(ids)}, f, indent=2)
+        frontier.close()
+        self.log.info(f'Stream cache: {self.cache.hits} hits, {self.cache.misses} misses')
+        self.cache.close()
+        if self.graph is not None:
+            try:
+                self.log.info(f'Saving graph arrays {self.graph.export()}')
+            except ValueError as e:
+                self.log.warning(f'{e}, only the edge list is saved')
+            self.graph.close()
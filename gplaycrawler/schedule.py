@@ -0,0 +1,290 @@
+# stdlib
+import asyncio
+import heapq
+import itertools
+import math
+import queue
+import sqlite3
+
+# internal
+from gplaycrawler.ids import IdCounter, IdRegistry
+
+
+class YieldScheduler:
+    '''
+    Orders search terms by the number of new ids they are expected to find. Other items (like the further pages
+    of a search term) go before all search terms.
+
+    The expectation for a term comes from its family, the terms with the same prefix (term[:-1]): the mean of
+    the new ids of the finished terms of the family, starting from the yield of the prefix itself (or the mean
+    of all terms) as prior. Families that keep returning nothing new sink to the back.
+    A term is scored again when it reaches the top of the heap, all terms after `len(heap) / rescore` new yields.
+    '''
+
+    prior_weight = 2
+    rescore = 16
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.yields = {}
+        self.families = {}
+        self.finished = 0
+        self.new = 0
+        self.changed = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def record(self, term, new):
+        '''
+        term found `new` new ids
+        '''
+        if new is None:
+            return
+        self.yields[term] = new
+        family = self.families.setdefault(term[:-1], [0, 0])
+        family[0] += 1
+        family[1] += new
+        self.finished += 1
+        self.new += new
+        self.changed += 1
+
+    def copy(self):
+        '''
+        new scheduler with the recorded yields but without terms
+        '''
+        other = YieldScheduler()
+        other.yields = dict(self.yields)
+        other.families = {prefix: list(family) for prefix, family in self.families.items()}
+        other.finished = self.finished
+        other.new = self.new
+        return other
+
+    def score(self, term):
+        if not isinstance(term, str):
+            return math.inf
+        prior = self.yields.get(term[:-1])
+        if prior is None:
+            prior = self.new / self.finished if self.finished else 0
+        finished, new = self.families.get(term[:-1], (0, 0))
+        return (new + prior * self.prior_weight) / (finished + self.prior_weight)
+
+    def push(self, term):
+        heapq.heappush(self.heap, (-self.score(term), next(self.counter), term))
+
+    def pop(self):
+        if self.changed and self.changed * self.rescore >= len(self.heap):
+            self.heap = [(-self.score(term), n, term) for _, n, term in self.heap]
+            heapq.heapify(self.heap)
+            self.changed = 0
+        while True:
+            _, n, term = heapq.heappop(self.heap)
+            score = self.score(term)
+            if not self.heap or score >= -self.heap[0][0]:
+                return term
+            # its family did worse than expected, try the next one
+            heapq.heappush(self.heap, (-score, n, term))
+
+
+class PopularityScheduler:
+    '''
+    Orders (depth, packageName) items by depth and within a depth by the number of apps that link to
+    packageName (its in-degree), most referenced first.
+
+    In-degrees only grow. An item is pushed again when its in-degree reaches a power of two and its older heap
+    entry is skipped, so there are only a few entries per item. At most `max_items` items are kept in memory,
+    the worse half is moved to a temporary SQLite database and read back in batches when the best items are
+    there. The in-degrees of all ids are counted over the handles of registry (an IdRegistry, best the one of
+    the crawl, so every name is stored once) or by indegree (like a CountMinSketch, in fixed memory).
+    '''
+
+    def __init__(self, max_items=100000, indegree=None, registry=None):
+        self.max_items = max_items
+        if indegree is None:
+            indegree = IdCounter(registry if registry is not None else IdRegistry())
+        self.indegree = indegree
+        self.heap = []
+        self.counter = itertools.count()
+        # latest heap entry of a packageName: [depth, -indegree, n, packageName, alive]
+        self.live = {}
+        self.size = 0
+        self.spilled = 0
+        # (depth, -indegree) of the best item in the database
+        self.spill_best = None
+        self.db = None
+
+    def __len__(self):
+        return self.size + self.spilled
+
+    def copy(self):
+        '''
+        new scheduler with the same in-degrees but without items
+        '''
+        return PopularityScheduler(self.max_items, self.indegree)
+
+    def reference(self, packageName):
+        '''
+        another app links to packageName
+        '''
+        n = self.indegree.increment(packageName)
+        if n & (n - 1):
+            return
+        entry = self.live.get(packageName)
+        if entry is not None:
+            entry[4] = False
+            self.live[packageName] = new = [entry[0], -n, next(self.counter), packageName, True]
+            heapq.heappush(self.heap, new)
+        elif self.spilled:
+            for (depth,) in self.db.execute('SELECT depth FROM spill WHERE id = ?', (packageName,)).fetchall():
+                self.db.execute('UPDATE spill SET score = ? WHERE id = ?', (n, packageName))
+                self.spill_best = min(self.spill_best, (depth, -n))
+
+    def push(self, item):
+        depth, packageName = item
+        self.live[packageName] = entry = [depth, -self.indegree[packageName], next(self.counter), packageName, True]
+        heapq.heappush(self.heap, entry)
+        self.size += 1
+        if self.size > self.max_items:
+            self._spill()
+
+    def pop(self):
+        while True:
+            while self.heap and not self.heap[0][4]:
+                heapq.heappop(self.heap)
+            if self.spilled and (not self.heap or (self.heap[0][0], self.heap[0][1]) > self.spill_best):
+                self._load()
+                continue
+            entry = heapq.heappop(self.heap)
+            entry[4] = False
+            if self.live.get(entry[3]) is entry:
+                del self.live[entry[3]]
+            self.size -= 1
+            return entry[0], entry[3]
+
+    def _spill(self):
+        if self.db is None:
+            # an empty filename is a temporary database that is deleted on close
+            self.db = sqlite3.connect('', check_same_thread=False)
+            self.db.execute('CREATE TABLE spill (n INTEGER PRIMARY KEY, id TEXT, depth INTEGER, score INTEGER)')
+            self.db.execute('CREATE INDEX spill_id ON spill (id)')
+            self.db.execute('CREATE INDEX spill_order ON spill (depth, score DESC)')
+        entries = sorted(entry for entry in self.heap if entry[4])
+        keep = self.max_items // 2
+        self.heap = entries[:keep]
+        for entry in entries[keep:]:
+            if self.live.get(entry[3]) is entry:
+                del self.live[entry[3]]
+        self.db.executemany(
+            'INSERT INTO spill (n, id, depth, score) VALUES (?, ?, ?, ?)',
+            ((n, packageName, depth, -score) for depth, score, n, packageName, _ in entries[keep:]),
+        )
+        best = (entries[keep][0], entries[keep][1])
+        self.spill_best = best if self.spill_best is None else min(self.spill_best, best)
+        self.spilled += len(entries) - keep
+        self.size = keep
+
+    def _load(self):
+        rows = self.db.execute(
+            'SELECT n, id, depth, score FROM spill ORDER BY depth, score DESC LIMIT ?', (max(self.max_items // 2, 1),)
+        ).fetchall()
+        self.db.executemany('DELETE FROM spill WHERE n = ?', ((n,) for n, _, _, _ in rows))
+        for n, packageName, depth, score in rows:
+            entry = [depth, -score, n, packageName, True]
+            heapq.heappush(self.heap, entry)
+            self.live.setdefault(packageName, entry)
+        self.spilled -= len(rows)
+        self.size += len(rows)
+        self.spill_best = None
+        for depth, score in self.db.execute('SELECT depth, score FROM spill ORDER BY depth, score DESC LIMIT 1'):
+            self.spill_best = (depth, -score)
+
+
+class SchedulerQueue(queue.Queue):
+    '''
+    queue.Queue that hands out its items in the order of a scheduler
+    '''
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        super().__init__()
+
+    def _init(self, maxsize):
+        self.queue = self.scheduler
+
+    def _put(self, item):
+        self.queue.push(item)
+
+    def _get(self):
+        return self.queue.pop()
+
+
+class AsyncSchedulerQueue(asyncio.Queue):
+    '''
+    asyncio version of SchedulerQueue
+    '''
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        super().__init__()
+
+    def _init(self, maxsize):
+        self._queue = self.scheduler
+
+    def _put(self, item):
+        self._queue.push(item)
+
+    def _get(self):
+        return self._queue.pop()
+
+
+class YieldQueue(SchedulerQueue):
+    '''
+    queue.Queue that hands out the terms of a YieldScheduler in order of expected yield
+    '''
+
+    def __init__(self, scheduler=None):
+        super().__init__(scheduler if scheduler is not None else YieldScheduler())
+
+    def record(self, term, new):
+        with self.mutex:
+            self.queue.record(term, new)
+
+
+class AsyncYieldQueue(AsyncSchedulerQueue):
+    '''
+    asyncio version of YieldQueue
+    '''
+
+    def __init__(self, scheduler=None):
+        super().__init__(scheduler if scheduler is not None else YieldScheduler())
+
+    def record(self, term, new):
+        self._queue.record(term, new)
+
+
+class PopularityQueue(SchedulerQueue):
+    '''
+    queue.Queue that hands out the items of a PopularityScheduler, most referenced first within a depth
+    '''
+
+    def __init__(self, scheduler=None):
+        super().__init__(scheduler if scheduler is not None else PopularityScheduler())
+
+    def reference(self, packageNames):
+        with self.mutex:
+            for packageName in packageNames:
+                self.queue.reference(packageName)
+
+
+class AsyncPopularityQueue(AsyncSchedulerQueue):
+    '''
+    asyncio version of PopularityQueue
+    '''
+
+    def __init__(self, scheduler=None):
+        super().__init__(scheduler if scheduler is not None else PopularityScheduler())
+
+    def reference(self, packageNames):
+        for packageName in packageNames:
+            self._queue.reference(packageName)
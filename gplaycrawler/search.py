@@ -1,22 +1,36 @@
+from os import path
 import json
 import threading
 import time
 import queue
-from requests.exceptions import HTTPError, ReadTimeout
-
-from playstoreapi.googleplay import GooglePlayAPI, LoginError
-from gplaycrawler.utils import get_logger
+from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
+
+from playstoreapi.config import DeviceBuilder, InvalidLocaleError
+from playstoreapi.googleplay import RequestError
+from gplaycrawler.feed import start_async_feeder, start_feeder
+from gplaycrawler.frontier import Frontier
+from gplaycrawler.ids import IdRegistry, IdSet
+from gplaycrawler.ratelimit import get_limiter
+from gplaycrawler.schedule import AsyncYieldQueue, YieldQueue, YieldScheduler
+from gplaycrawler.session import Backoff, SessionPool
+from gplaycrawler.utils import get_logger, strip_suffix
 
 import string
 import itertools
 
 
 class Search:
+    # adaptive mode: a prefix is expanded when its search returned at least `saturated` ids
+    # (the result list is probably cut off) or at least `min_new` ids that were not known yet
+    saturated = 100
+    min_new = 10
+
     def __init__(self, locale='en_US', timezone='UTC', device='px_3a', delay=None, log_level='info'):
         self.locale = locale
         self.timezone = timezone
         self.device = device
         self.delay = delay
+        self.limiter = get_limiter(delay)
 
         self.log_level = log_level
         self.log = get_logger(log_level, name=__name__)
@@ -27,138 +41,221 @@ class Search:
         else:
             self.quiet = True
 
-    def search(self, api, nextPageUrl=None, query=None):
-        np = queue.Queue()
-        if query is None:
-            np.put_nowait(nextPageUrl)
+        self.pool = SessionPool(locale, timezone, device, limiter=self.limiter, quiet=self.quiet, log=self.log)
+        # searched locales, alphabets of the search terms and the alphabet of every character
+        self.locales = [locale]
+        self.alphabets = [string.ascii_lowercase]
+        self.alphabet = {c: string.ascii_lowercase for c in string.ascii_lowercase}
+
+        # pages fetched in this run (by locale and nextPageUrl, the locale is not part of the url)
+        # and the search terms with pages left: [pages, ids]
+        self.lock = threading.Lock()
+        self.pages = set()
+        self.pending = {}
 
+    def search(self, api, nextPageUrl=None, query=None):
+        '''
+        get one page of results for query or nextPageUrl, returns the ids and the nextPageUrls on the page
+        '''
+        result = api.search(query=query, nextPageUrl=nextPageUrl)
         ids = set()
-        done = set()
-        num_pages = 0
-        while not np.empty() or query is not None:
-            nextPageUrl = None
-            if query is None:
-                nextPageUrl = np.get_nowait()
-                if nextPageUrl in done:
-                    continue
-                done.add(nextPageUrl)
+        nextPageUrls = []
 
-            try:
-                result = api.search(query=query, nextPageUrl=nextPageUrl)
-                query = None
-            except HTTPError as e:
-                if e.response.status_code == 429 or e.response.status_code == 401:
-                    if e.response.status_code == 401:
-                        self.log.warning('Unauthorized. Trying relogin...')
-                    else:
-                        self.log.warning('search got rate limited')
-                    api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-                    while True:
-                        try:
-                            api.envLogin(quiet=self.quiet, check=False)
-                        except LoginError:
-                            self.log.info('Login failed. Retry in 3 minutes')
-                            time.sleep(180)
-                        else:
-                            break
-                    self.log.debug('new api, logged in, try again')
-                    np.put_nowait(nextPageUrl)
-                else:
-                    self.log.warning(str(e))
-                continue
+        if len(result) != 1:
+            self.log.warning(f'Pages: Got result with len {len(result)}')
+            self.log.debug(result)
+            return ids, nextPageUrls
 
-            if len(result) != 1:
-                self.log.warning(f'Pages: Got result with len {len(result)}')
-                self.log.debug(result)
-                continue
+        doc = result[0]
+        clusters = doc.get('subItem')
+
+        try:
+            nextPageUrls.append(doc['containerMetadata']['nextPageUrl'])
+        except KeyError:
+            pass
 
-            doc = result[0]
-            clusters = doc.get('subItem')
+        if clusters is None:
+            self.log.debug('No clusters found in searchPages')
+            return ids, nextPageUrls
 
+        # at the first page there are also the clusters 'Recommended for you' and 'Related Searches'
+        # so the item can be list of apps or related search terms
+        for cluster in clusters:
+            apps = 0
             try:
-                np.put_nowait(doc['containerMetadata']['nextPageUrl'])
+                items = cluster['subItem']
             except KeyError:
-                pass
-
-            if clusters is None:
-                self.log.debug('No clusters found in searchPages')
-                continue
-
-            num_pages += 1
-
-            # at the first page there are also the clusters 'Recommended for you' and 'Related Searches'
-            # so the item can be list of apps or related search terms
-            for cluster in clusters:
-                apps = 0
+                items = []
+            for item in items:
                 try:
-                    items = cluster['subItem']
-                except KeyError:
-                    items = []
-                for item in items:
-                    try:
-                        ids.add(item['id'])
-                    except KeyError:
-                        pass
-                    else:
-                        apps += 1
-                self.log.debug(f"queue: {np.qsize()}, pages: Found {apps} apps in cluster {cluster.get('title')}")
-
-                try:
-                    np.put_nowait(cluster['containerMetadata']['nextPageUrl'])
+                    ids.add(item['id'])
                 except KeyError:
                     pass
-        return ids
-
-    def worker(self, api, q, ids, done_searchTerms, tmp_file, threads):
-        while not q.empty():
-            searchTerm = q.get_nowait()  # non blocking
-            self.log.debug(f'Start searching "{searchTerm}"')
+                else:
+                    apps += 1
+            self.log.debug(f"pages: Found {apps} apps in cluster {cluster.get('title')}")
 
             try:
-                sids = self.search(api, query=searchTerm)
+                nextPageUrls.append(cluster['containerMetadata']['nextPageUrl'])
+            except KeyError:
+                pass
+        return ids, nextPageUrls
+
+    def key(self, locale, searchTerm):
+        '''
+        queue and frontier key of searchTerm in locale. Search terms of the main locale have no prefix
+        '''
+        if locale == self.locale:
+            return searchTerm
+        return f'{locale}:{searchTerm}'
+
+    def split(self, key):
+        '''
+        locale and search term of a key, the prefix before the first ':' if it is one of the searched locales
+        '''
+        locale, sep, searchTerm = key.partition(':')
+        if sep and locale in self.locales:
+            return locale, searchTerm
+        return self.locale, key
+
+    def fetch(self, api, item):
+        '''
+        get the page of a queue item: a search term key or (key, nextPageUrl)
+        '''
+        key = item[0] if isinstance(item, tuple) else item
+        locale, searchTerm = self.split(key)
+        # api objects are per thread, so the locale can be switched for every request
+        if api.deviceBuilder.locale != locale:
+            api.setLocale(locale)
+        if isinstance(item, tuple):
+            return self.search(api, nextPageUrl=item[1])
+        return self.search(api, query=searchTerm)
+
+    def addPage(self, item, page, q, ids, done_searchTerms, frontier, max_length):
+        '''
+        collect the page of a queue item, returns the new queue items.
+        Pages that were not fetched before in the locale (by any search term) become items of their own,
+        a search term is saved when all of its pages are done
+        '''
+        sids, nextPageUrls = page
+        new_items = []
+        locale = self.split(item[0] if isinstance(item, tuple) else item)[0]
+        with self.lock:
+            if isinstance(item, tuple):
+                searchTerm = item[0]
+                entry = self.pending[searchTerm]
+                entry[0] -= 1
+                entry[1].update(sids)
+            else:
+                searchTerm = item
+                entry = self.pending[searchTerm] = [0, sids]
+
+            for nextPageUrl in nextPageUrls:
+                if (locale, nextPageUrl) not in self.pages:
+                    self.pages.add((locale, nextPageUrl))
+                    entry[0] += 1
+                    new_items.append((searchTerm, nextPageUrl))
+            if entry[0] > 0:
+                return new_items
+
+            del self.pending[searchTerm]
+            sids = entry[1]
+            new = self.saveResult(searchTerm, sids, ids, done_searchTerms, frontier, q.qsize())
+        q.record(searchTerm, new)
+        for child in self.expand(searchTerm, len(sids), new, max_length):
+            if child not in done_searchTerms:
+                new_items.append(child)
+        return new_items
+
+    def failed(self, item):
+        '''
+        page of a queue item whose request failed for good. A further page counts as empty, so its search term
+        is still finished with the ids of its other pages. A search term itself is searched again by the next
+        run (None)
+        '''
+        return (set(), []) if isinstance(item, tuple) else None
+
+    def saveResult(self, searchTerm, sids, ids, done_searchTerms, frontier, todo):
+        '''
+        add the ids found for searchTerm and record it in the frontier
+        '''
+        new_ids = sids - ids
+        ids.update(new_ids)
+        self.log.debug(f'{searchTerm}: Got {len(sids)} package names, {len(new_ids)} new')
+
+        self.log.info(f'Done: {len(done_searchTerms)}, to do: {todo} received {len(ids)} ids')
+        done_searchTerms.add(searchTerm)
+
+        frontier.add_ids(new_ids)
+        frontier.mark_done(searchTerm, found=len(sids), new=len(new_ids))
+        frontier.checkpoint()
+        return len(new_ids)
+
+    def expand(self, searchTerm, found, new, max_length):
+        '''
+        children of the search term key searchTerm that are worth searching in the adaptive mode.
+        A search term is only expanded with characters of the alphabet of its last character
+        '''
+        _, term = self.split(searchTerm)
+        if max_length is None or len(term) >= max_length or found is None:
+            return []
+        if found < self.saturated and (new is None or new < self.min_new):
+            self.log.debug(f'{searchTerm}: pruned ({found} ids, {new} new)')
+            return []
+        return [searchTerm + c for c in self.alphabet.get(term[-1], '')]
+
+    def worker(self, q, ids, done_searchTerms, frontier, max_length=None):
+        api = self.pool.get()
+        backoff = Backoff()
+        while True:
+            try:
+                item = q.get(timeout=1)
+            except queue.Empty:
+                # other workers can still add pages and terms
+                if q.unfinished_tasks == 0:
+                    break
+                continue
+            self.log.debug(f'Start searching {item}')
 
-            except HTTPError as e:
-                if e.response.status_code == 429 or e.response.status_code == 401:
-                    if e.response.status_code == 401:
-                        self.log.warning('Unauthorized. Trying relogin...')
-                    else:
-                        self.log.warning('search worker got rate limited')
-                    api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-                    while True:
-                        try:
-                            api.envLogin(quiet=self.quiet, check=False)
-                        except LoginError:
-                            self.log.info('Login failed. Retry in 3 minutes')
-                            time.sleep(180)
+            # the item is finished, whatever happens, or the workers never stop
+            try:
+                try:
+                    page = self.fetch(api, item)
+                    backoff.reset()
+                except HTTPError as e:
+                    page = None
+                    if e.response.status_code == 429 or e.response.status_code == 401:
+                        if e.response.status_code == 401:
+                            self.log.warning('Unauthorized. Trying relogin...')
                         else:
-                            break
-                    self.log.debug(f'new api, logged in, add back {searchTerm}')
-                    q.put_nowait(searchTerm)
-                    q.task_done()
-                    continue
-                else:
-                    self.log.warning(str(e))
-
-            except ReadTimeout:
-                self.log.debug(f'Request did timeout (search), add back {searchTerm}')
-                q.put_nowait(searchTerm)
+                            self.log.warning('search worker got rate limited')
+                            backoff.sleep()
+                        api = self.pool.relogin()
+                        self.log.debug(f'new api, logged in, add back {item}')
+                        q.put_nowait(item)
+                    else:
+                        self.log.warning(str(e))
+                        page = self.failed(item)
+                except (ReadTimeout, ConnectionError) as e:
+                    page = None
+                    self.log.debug(f'{type(e).__name__} (search), add back {item}')
+                    if isinstance(e, ConnectionError):
+                        backoff.sleep()
+                    q.put_nowait(item)
+                except RequestError as e:
+                    self.log.warning(f'{item}: {str(e)}')
+                    page = self.failed(item)
+                except Exception as e:
+                    self.log.warning(f'{item}: {type(e).__name__}: {str(e)}')
+                    page = self.failed(item)
+
+                if page is not None:
+                    for new_item in self.addPage(item, page, q, ids, done_searchTerms, frontier, max_length):
+                        q.put_nowait(new_item)
+            except Exception as e:
+                self.log.warning(f'{item}: {type(e).__name__}: {str(e)}')
+            finally:
                 q.task_done()
-                continue
-
-            q.task_done()
-            before = len(ids)
-            ids.update(sids)
-            new = len(ids) - before
-            self.log.debug(f'{searchTerm}: Got {len(sids)} package names, {new} new')
-
-            self.log.info(f'Done: {len(done_searchTerms)}, to do: {q.qsize()} received {len(ids)} ids')
-            done_searchTerms.add(searchTerm)
-
-            # save tmp file regularly
-            if len(done_searchTerms) % (100 * len(threads)) == 0:
-                self.log.debug(f'Saving tmp file {tmp_file}')
-                with open(tmp_file, 'w') as f:
-                    json.dump({"done": list(done_searchTerms), "ids": list(ids)}, f, indent=2)
 
         t = threading.current_thread()
         self.log.info(f'{t.name} finished. Queue empty')
@@ -166,83 +263,149 @@ class Search:
         return
 
     def get_strings(self, alphabet):
-        with open('chars.json') as f:
+        '''
+        characters of an alphabet from chars.json in the current directory or the one of the package
+        '''
+        chars_file = 'chars.json'
+        if not path.exists(chars_file):
+            chars_file = path.join(path.dirname(__file__), 'chars.json')
+        with open(chars_file) as f:
             chars = json.load(f)
         for charset in chars:
             if charset['name'] == alphabet:
                 return charset['chars']
+        raise ValueError(f'Unknown alphabet {alphabet}, known: {", ".join(c["name"] for c in chars)}')
 
     def generate_strings(self, length=3):
-        chars = string.ascii_lowercase
-        # nums = string.digits
-
-        for item in itertools.product(chars, repeat=length):
-            yield "".join(item)
+        # strings are not mixed from different alphabets
+        for chars in self.alphabets:
+            for item in itertools.product(chars, repeat=length):
+                yield "".join(item)
+
+    def generate_keys(self, locales, length, skip):
+        '''
+        keys of all strings of `length` characters in every locale, except the ones in skip.
+        The locales take turns, so all of them are searched from the start
+        '''
+        generators = [self.generate_strings(length=length) for _ in locales]
+        for searchTerms in zip(*generators):
+            for locale, searchTerm in zip(locales, searchTerms):
+                key = self.key(locale, searchTerm)
+                if key not in skip:
+                    yield key
+
+    async def asyncSearch(self, engine, q, todo, ids, done_searchTerms, frontier, max_length=None):
+        '''
+        same as worker but for all items in the YieldQueue q and the search terms of todo,
+        running on the event loop of engine
+        '''
+        aq = AsyncYieldQueue(q.scheduler.copy())
+        while not q.empty():
+            aq.put_nowait(q.get_nowait())
+        feeder = start_async_feeder(engine, aq, todo)
 
-    def getSearch(self, out_file, num_threads, length):
-        all_searchTerms = set()
-        for s in self.generate_strings(length=length):
-            all_searchTerms.add(s.lower())
+        async def handler(item):
+            self.log.debug(f'Start searching {item}')
+            try:
+                page = await engine.request(self.fetch, item)
+            except (ReadTimeout, ConnectionError):
+                # added back by drain
+                raise
+            except HTTPError as e:
+                if e.response.status_code == 429 or e.response.status_code == 401:
+                    raise
+                self.log.warning(str(e))
+                page = self.failed(item)
+            except Exception as e:
+                self.log.warning(f'{item}: {type(e).__name__}: {str(e)}')
+                page = self.failed(item)
+            if page is None:
+                return
+            for new_item in self.addPage(item, page, aq, ids, done_searchTerms, frontier, max_length):
+                aq.put_nowait(new_item)
+
+        await engine.drain(aq, handler)
+        await feeder
+
+    def getSearch(self, out_file, num_threads, length, engine=None, adaptive=False, alphabets=None, locales=None):
+        '''
+        search all strings of `length` characters of every alphabet (default: latin) in every locale
+        (default: the locale of the crawler). In the adaptive mode start with single characters and only expand
+        promising prefixes, up to `length` characters
+        '''
+        max_length = length if adaptive else None
+        locales = self.locales = locales or [self.locale]
+        for locale in locales:
+            # the api only takes locales like en_US, check them before anything is searched
+            try:
+                DeviceBuilder(self.device).setLocale(locale)
+            except InvalidLocaleError:
+                raise ValueError(f'Unsupported locale {locale}, the api only takes locales like en_US')
+        alphabets = dict.fromkeys(alphabets or ['latin'])
+        self.alphabets = [self.get_strings(alphabet) for alphabet in alphabets]
+        self.alphabet = {c: chars for chars in self.alphabets for c in chars}
 
-        out_file = out_file.rstrip('.json')
+        out_file = strip_suffix(out_file, '.json')
 
+        # resume from the frontier, a tmp file of older versions is imported once
+        frontier = self.frontier = Frontier(out_file + '_frontier.db')
         tmp_file = out_file + '_tmp.json'
-
-        ids = set()
-        done_searchTerms = set()
-
-        # resume from tmp file if it exists
-        try:
-            with open(tmp_file) as f:
-                done = json.load(f)
-            done_searchTerms.update(done['done'])
-            ids.update(done['ids'])
-        except FileNotFoundError:
-            pass
-        except Exception as e:
-            self.log.warning(str(e))
-
-        todo_seachTerms = all_searchTerms - done_searchTerms
-        q = queue.Queue()
-        for searchTerm in todo_seachTerms:
-            q.put_nowait(searchTerm)
-
-        self.log.info(f'Done: {len(done_searchTerms)}, to do: {q.qsize()} received {len(ids)} ids')
-
-        i = 0
-        threads = []
-        while num_threads > 0:
-            while len(threads) < num_threads:
-                api = GooglePlayAPI(self.locale, self.timezone, self.device, delay=self.delay)
-                while True:
-                    try:
-                        api.envLogin(quiet=self.quiet, check=False)
-                    except LoginError:
-                        self.log.info('Login failed. Retry in 3 minutes')
-                        time.sleep(180)
-                    else:
-                        break
-                t = threading.Thread(target=self.worker, args=(api, q, ids, done_searchTerms, tmp_file, threads))
-                i += 1
-                t.name = f'Worker-{i}'
-                t.done = False
-                threads.append(t)
-                t.start()
-                self.log.info(f'Started {t.name}')
-                # wait 10-11 min to start next thread
-                # time.sleep(60 * 10 + random() * 60)
-
-            for t in threads:
-                t.join(timeout=1)
-                if not t.is_alive():
-                    if t.done:
-                        num_threads -= 1
-                    else:
+        if frontier.is_empty() and path.exists(tmp_file):
+            self.log.info(f'Importing {tmp_file}')
+            frontier.import_json(tmp_file)
+
+        ids = IdSet(IdRegistry(), (i for i, _ in frontier.iter_ids()))
+        done = frontier.done()
+        done_searchTerms = set(done)
+
+        # terms are searched in order of the expected number of new ids, known yields come from the frontier
+        scheduler = YieldScheduler()
+        for searchTerm, (found, new) in done.items():
+            scheduler.record(searchTerm, new)
+        q = YieldQueue(scheduler)
+
+        # the generated terms are fed while the workers run, there can be millions of them
+        todo = self.generate_keys(locales, 1 if adaptive else length, done_searchTerms)
+
+        if adaptive:
+            # continue the expansion of the earlier runs
+            for searchTerm, (found, new) in done.items():
+                for child in self.expand(searchTerm, found, new, max_length):
+                    if child not in done_searchTerms:
+                        q.put_nowait(child)
+
+        self.log.info(f'Done: {len(done_searchTerms)}, received {len(ids)} ids')
+
+        if engine is not None:
+            engine.run(self.pool, self.asyncSearch, engine, q, todo, ids, done_searchTerms, frontier, max_length)
+        else:
+            start_feeder(q, todo)
+            i = 0
+            threads = []
+            while num_threads > 0:
+                while len(threads) < num_threads:
+                    t = threading.Thread(target=self.worker, args=(q, ids, done_searchTerms, frontier, max_length))
+                    i += 1
+                    t.name = f'Worker-{i}'
+                    t.done = False
+                    threads.append(t)
+                    t.start()
+                    self.log.info(f'Started {t.name}')
+                    # wait 10-11 min to start next thread
+                    # time.sleep(60 * 10 + random() * 60)
+
+                for t in list(threads):
+                    t.join(timeout=1)
+                    if not t.is_alive():
                         threads.remove(t)
-                        self.log.info(f'Worker {t.name} crashed. Starting a new worker')
-                        time.sleep(1)
+                        if t.done:
+                            num_threads -= 1
+                        else:
+                            self.log.info(f'Worker {t.name} crashed. Starting a new worker')
+                            time.sleep(1)
 
-        self.log.info('Threads finished')
+        self.log.info('Workers finished')
+        frontier.close()
         self.log.info(f'Saving out file {out_file}.json')
         with open(out_file + '.json', 'w') as f:
             json.dump({"done": list(done_searchTerms), "ids": list(ids)}, f, indent=2)
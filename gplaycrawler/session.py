@@ -0,0 +1,106 @@
+# stdlib
+import random
+import threading
+import time
+
+# external
+from playstoreapi.googleplay import LoginError
+
+# internal
+from gplaycrawler.api import CrawlerAPI
+
+
+class Backoff:
+    '''
+    Exponential backoff with full jitter: the n-th delay is random between 0 and min(cap, base * 2^n) seconds
+    '''
+
+    def __init__(self, base=1, cap=180):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def delay(self):
+        d = random.uniform(0, min(self.cap, self.base * 2**self.attempt))
+        self.attempt += 1
+        return d
+
+    def sleep(self):
+        time.sleep(self.delay())
+
+    def reset(self):
+        self.attempt = 0
+
+
+class SessionPool:
+    '''
+    Hands out logged in api objects.
+
+    There is only one login at a time. Every thread gets its own api object (and with that its own http session)
+    with a copy of the credentials of that login. When several workers ask for a relogin because of the same
+    401/429, only the first one logs in and the others get the new credentials.
+    '''
+
+    # everything GooglePlayAPI.getHeaders() needs after a login
+    credentials = ['gsfId', 'authSubToken', 'device_config_token', 'deviceCheckinConsistencyToken', 'dfeCookie']
+
+    def __init__(self, locale, timezone, device, limiter=None, quiet=True, check=False, log=None, factory=CrawlerAPI):
+        self.locale = locale
+        self.timezone = timezone
+        self.device = device
+        self.limiter = limiter
+        self.quiet = quiet
+        self.check = check
+        self.log = log
+        self.factory = factory
+
+        self.api = None
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _login(self):
+        backoff = Backoff()
+        while True:
+            api = self.factory(self.locale, self.timezone, self.device, limiter=self.limiter)
+            try:
+                api.envLogin(quiet=self.quiet, check=self.check)
+            except LoginError:
+                delay = backoff.delay()
+                self.log.info(f'Login failed. Retry in {delay:.1f} seconds')
+                time.sleep(delay)
+            else:
+                return api
+
+    def get(self):
+        '''
+        logged in api object for the current thread
+        '''
+        with self.lock:
+            if self.api is None:
+                self.api = self._login()
+                self.generation += 1
+            api = self.api
+            generation = self.generation
+
+        if getattr(self.local, 'generation', None) != generation:
+            clone = self.factory(self.locale, self.timezone, self.device, limiter=self.limiter)
+            for attr in self.credentials:
+                setattr(clone, attr, getattr(api, attr, None))
+            self.local.api = clone
+            self.local.generation = generation
+        return self.local.api
+
+    def relogin(self, generation=None):
+        '''
+        login again and return a new api object for the current thread.
+        If there was already a login after `generation` (default: the one of the calling thread) just use that
+        '''
+        if generation is None:
+            generation = getattr(self.local, 'generation', None)
+        with self.lock:
+            if generation == self.generation:
+                self.api = self._login()
+                self.generation += 1
+                self.log.debug(f'Logged in again (login {self.generation})')
+        return self.get()
@@ -0,0 +1,177 @@
+# stdlib
+from os import path, mkdir, listdir
+import gzip
+import io
+import json
+import threading
+import time
+
+# external (optional)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ShardStore:
+    '''
+    Append-only metadata store for millions of apps.
+
+    Records are JSON lines ({"package": ..., "fetched": ..., "details": ...}) that are compressed in blocks of
+    `block_size` records (one gzip member or zstd frame per block) and appended to shards of up to
+    `shard_size` bytes. Concatenated members/frames are still one valid compressed JSONL file, so a shard can
+    be streamed with standard tools. For random lookup `index.tsv` holds one line per record:
+    package, shard, offset and length of the block and the line in the block.
+    The index is written after the block, so it never points to data that isn't on disk.
+    '''
+
+    suffixes = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+    def __init__(self, directory, compression='gzip', block_size=64, shard_size=256 * 1024 * 1024):
+        if compression not in self.suffixes:
+            raise ValueError(f'Unknown compression {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        self.directory = directory
+        self.compression = compression
+        self.block_size = block_size
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.index = {}
+
+        try:
+            mkdir(directory)
+        except FileExistsError:
+            pass
+
+        self.index_file = path.join(directory, 'index.tsv')
+        if path.exists(self.index_file):
+            size = 0
+            with open(self.index_file, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    size += len(line)
+                    self._index_line(line.decode())
+            # drop a half written line of a crashed run, or the next line is appended to it
+            if size != path.getsize(self.index_file):
+                with open(self.index_file, 'r+b') as f:
+                    f.truncate(size)
+
+        # never append to a shard of an earlier run, it could end with a half written block
+        shards = [int(name.split('-')[1].split('.')[0]) for name in listdir(directory) if name.startswith('shard-')]
+        self.shard = max(shards, default=-1)
+        self.fp = None
+        self.index_fp = open(self.index_file, 'a')
+
+    def _index_line(self, line):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 5:
+            # two lines merged by a crash of an older version
+            return
+        packageName, shard, offset, length, n = fields
+        self.index[packageName] = (int(shard), int(offset), int(length), int(n))
+
+    def _shard_path(self, shard):
+        for suffix in self.suffixes.values():
+            filename = path.join(self.directory, f'shard-{shard:05d}{suffix}')
+            if path.exists(filename):
+                return filename
+        return path.join(self.directory, f'shard-{shard:05d}{self.suffixes[self.compression]}')
+
+    def _compress(self, data):
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        return gzip.compress(data)
+
+    @staticmethod
+    def _decompress(filename, data):
+        if filename.endswith('.zst'):
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        if self.fp is None or self.fp.tell() >= self.shard_size:
+            if self.fp is not None:
+                self.fp.close()
+            self.shard += 1
+            self.fp = open(self._shard_path(self.shard), 'ab')
+
+        block = self._compress(b''.join(line for _, line in self.buffer))
+        offset = self.fp.tell()
+        self.fp.write(block)
+        self.fp.flush()
+
+        for n, (packageName, _) in enumerate(self.buffer):
+            self.index_fp.write(f'{packageName}\t{self.shard}\t{offset}\t{len(block)}\t{n}\n')
+            self.index[packageName] = (self.shard, offset, len(block), n)
+        self.index_fp.flush()
+        self.buffer = []
+
+    def put(self, packageName, details, **fields):
+        '''
+        add (a new revision of) the details of packageName. Extra fields are stored with the record
+        '''
+        record = {'package': packageName, 'fetched': int(time.time())}
+        record.update(fields)
+        record['details'] = details
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode()
+        with self.lock:
+            self.buffer.append((packageName, line))
+            if len(self.buffer) >= self.block_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def __contains__(self, packageName):
+        return packageName in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def packages(self):
+        return set(self.index)
+
+    def get(self, packageName):
+        '''
+        latest record of packageName or None
+        '''
+        try:
+            shard, offset, length, n = self.index[packageName]
+        except KeyError:
+            return None
+        filename = self._shard_path(shard)
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            data = self._decompress(filename, f.read(length))
+        return json.loads(data.splitlines()[n])
+
+    def records(self):
+        '''
+        stream all records of all shards (including older revisions) in the order they were written
+        '''
+        self.flush()
+        shards = sorted(name for name in listdir(self.directory) if name.startswith('shard-'))
+        for name in shards:
+            with self._open(path.join(self.directory, name)) as f:
+                for line in f:
+                    yield json.loads(line)
+
+    @staticmethod
+    def _open(filename):
+        if filename.endswith('.zst'):
+            raw = open(filename, 'rb')
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True))
+        return gzip.open(filename, 'rb')
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.fp is not None:
+                self.fp.close()
+            self.index_fp.close()
@@ -51,3 +51,12 @@ def get_logger(log_level, name=__name__):
     # logger.propagate = False  # no logging of libs
     coloredlogs.install(level=log_level, logger=logger, fmt=fmt, datefmt=datefmt, level_styles=ls, field_styles=fs)
     return logger
+
+
+def strip_suffix(s, suffix):
+    '''
+    s without suffix if it ends with it (str.rstrip strips characters, not a suffix)
+    '''
+    if suffix and s.endswith(suffix):
+        return s[: -len(suffix)]
+    return s
@@ -0,0 +1,123 @@
+# stdlib
+from functools import partial
+from os import listdir, path
+import json
+
+# external
+from requests.exceptions import ConnectionError
+import pytest
+
+# internal
+from gplaycrawler.aio import AsyncEngine
+from gplaycrawler.bench import Backend, BenchAPI
+from gplaycrawler.metadata import Metadata
+from gplaycrawler.packages import Packages
+from gplaycrawler.related import Related
+from gplaycrawler.search import Search
+from gplaycrawler.session import Backoff
+
+commands = ['search', 'related', 'metadata', 'packages']
+engines = ['threads', 'async']
+options = {'apps': 2000, 'page_size': 5, 'pages': 3, 'latency': 0, 'apk_size': 1 << 12}
+locales = ['en_US', 'de_DE']
+
+
+class FlakyBackend(Backend):
+    '''
+    Backend that answers every `every`-th request with a ConnectionError
+    '''
+
+    def __init__(self, every=7, **kwargs):
+        super().__init__(**kwargs)
+        self.every = every
+
+    def request(self):
+        super().request()
+        if self.requests % self.every == 0:
+            raise ConnectionError('Connection reset by peer')
+
+
+@pytest.fixture(autouse=True)
+def setup(monkeypatch, tmp_path):
+    # the loggers write a file to the current directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Backoff, 'delay', lambda self: 0)
+
+
+def crawl(command, directory, engine, backend):
+    '''
+    run command against backend with its output in directory, returns the output
+    '''
+    if command == 'packages' and backend.server is None:
+        backend.serve()
+    url = None if backend.server is None else f'http://127.0.0.1:{backend.server.server_port}'
+    classes = {'search': Search, 'related': Related, 'metadata': Metadata, 'packages': Packages}
+    cmd = classes[command](delay=None, log_level='warning')
+    cmd.pool.factory = partial(BenchAPI, backend=backend, url=url)
+    engine = AsyncEngine(concurrency=4, log_level='warning') if engine == 'async' else None
+
+    directory.mkdir(exist_ok=True)
+    in_file = str(directory / 'in.json')
+    out = str(directory / 'out')
+    with open(in_file, 'w') as f:
+        json.dump([f'bench.app{i}' for i in range(0, 200, 20)], f)
+
+    if command == 'search':
+        cmd.getSearch(out, 4, 1, engine=engine, locales=locales)
+    elif command == 'related':
+        cmd.getRelated(in_file, out, until_level=1, threads=4, engine=engine)
+    elif command == 'metadata':
+        cmd.getMetadata(in_file, out, 4, engine=engine)
+    elif command == 'packages':
+        cmd.getPackages(in_file, out, 4, False, False, engine=engine)
+
+    if command in ('search', 'related'):
+        with open(out + '.json') as f:
+            result = json.load(f)
+        return {'done': sorted(result['done']), 'ids': sorted(result['ids'])}
+    files = {}
+    for name in listdir(out):
+        if name.endswith('.json') or name.endswith('.apk'):
+            with open(path.join(out, name), 'rb') as f:
+                files[name] = f.read()
+    return files
+
+
+@pytest.mark.parametrize('command', commands)
+def test_engines(command, tmp_path):
+    '''
+    both engines give the same output and a second run resumes without requests
+    '''
+    outputs = {}
+    for engine in engines:
+        backend = Backend(**options)
+        outputs[engine] = crawl(command, tmp_path / engine, engine, backend)
+        assert outputs[engine]
+
+        backend.requests = 0
+        assert crawl(command, tmp_path / engine, engine, backend) == outputs[engine]
+        assert backend.requests == 0
+    assert outputs['threads'] == outputs['async']
+
+
+@pytest.mark.parametrize('engine', engines)
+@pytest.mark.parametrize('command', commands)
+def test_connection_errors(command, engine, tmp_path):
+    '''
+    items that fail with a ConnectionError are tried again, nothing is lost
+    '''
+    expected = crawl(command, tmp_path / 'clean', engine, Backend(**options))
+    backend = FlakyBackend(**options)
+    assert crawl(command, tmp_path / 'flaky', engine, backend) == expected
+    assert backend.requests > backend.every
+
+
+@pytest.mark.parametrize('engine', engines)
+def test_search_locales(engine, tmp_path):
+    '''
+    every page is fetched in every locale, the locale is not part of the nextPageUrl
+    '''
+    backend = Backend(**options)
+    result = crawl('search', tmp_path, engine, backend)
+    assert backend.requests == 26 * len(locales) * options['pages']
+    assert 'de_DE:a' in result['done']